@@ -10,6 +10,7 @@
 --       Assignment          FK Course, FK Page
 --       Registration        FK Person, FK Course, FK Role
 --       Work 		     FK Person, FK Assignment, FK Page
+--       Generation
 --
 --   To create the database :          ../bin/umber_init_db
 --   To create an ERD diagram of it:   ./erd/make_png
@@ -120,6 +121,9 @@ CREATE TABLE Registration (
 -- Faculty assign 'em ("Read this; write that") and grade 'em.
 -- The "nth" field gives each a (1,2,3,...) number within one course.
 -- The "notes" field is (again) for possible future expansion
+-- The "due_epoch" field is "due" in seconds since 1970, or 0 if blank ;
+-- it's set whenever the row is saved (see model.py's epoch_of)
+-- so that queries can compare dates in sql.
 --
 CREATE TABLE Assignment (
   assignment_id INTEGER PRIMARY KEY NOT NULL,
@@ -132,9 +136,12 @@ CREATE TABLE Assignment (
   blurb_hash TEXT NOT NULL DEFAULT '',
   blurb_html TEXT NOT NULL DEFAULT '',  
   active INTEGER NOT NULL DEFAULT 1,
-  notes TEXT NOT NULL DEFAULT ''
+  notes TEXT NOT NULL DEFAULT '',
+  due_epoch INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE INDEX assignment_course_due ON Assignment(course_id, due_epoch);
+
 --
 -- Work corresponds to a web page where a student submits their work
 -- for an Assignment, and where faculty comments on and grades that work.
@@ -145,6 +152,10 @@ CREATE TABLE Assignment (
 -- An empty string means the student hasn't submitted anything yet.
 -- Similarly, the *_seen and *_modified fields are the dates when
 -- the work page was last seen and last modified.
+-- Each of those five also has an *_epoch integer version,
+-- in seconds since 1970 or 0 if blank, kept in sync like due_epoch.
+-- There is at most one Work for an assignment and person ; see
+-- work_assignment_person below.
 -- The "notes" field is for possible future expansion.
 --
 CREATE TABLE Work (
@@ -161,6 +172,30 @@ CREATE TABLE Work (
   faculty_seen TEXT NOT NULL DEFAULT '',
   faculty_modified TEXT NOT NULL DEFAULT '',
   grade TEXT NOT NULL DEFAULT '',
-  notes TEXT NOT NULL DEFAULT ''
+  notes TEXT NOT NULL DEFAULT '',
+  submitted_epoch INTEGER NOT NULL DEFAULT 0,
+  student_seen_epoch INTEGER NOT NULL DEFAULT 0,
+  student_modified_epoch INTEGER NOT NULL DEFAULT 0,
+  faculty_seen_epoch INTEGER NOT NULL DEFAULT 0,
+  faculty_modified_epoch INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX work_assignment_submitted ON Work(assignment_id, submitted_epoch);
+CREATE INDEX work_person ON Work(person_id);
+CREATE UNIQUE INDEX work_assignment_person ON Work(assignment_id, person_id);
+
+
+--
+-- A Generation is a counter for some kind of cached data
+-- (e.g. 'courses', the set of course paths) that each server process
+-- keeps in memory. Changing that data bumps its value, to the next
+-- number in one sequence shared by all the rows, so that a process can
+-- find everything changed since it last looked with one query:
+--   SELECT name, value FROM Generation WHERE value > <last seen value>
+--
+CREATE TABLE Generation (
+  name TEXT PRIMARY KEY NOT NULL,
+  value INTEGER NOT NULL DEFAULT 0
 );
 
+CREATE INDEX generation_value ON Generation(value);
@@ -0,0 +1,148 @@
+"""
+ filestat.py
+
+ A per-process cache of file metadata, so that a page view does
+ one os.stat per path rather than a series of os.path.exists(),
+ isfile(), isdir() and os.stat() calls, which add up on a network
+ file system and for folder listings.
+
+ Each cached stat is remembered along with the modification time of
+ its enclosing folder. That folder's time is itself checked at most
+ once per request (or every file_stat_seconds outside of requests),
+ so creating, deleting or renaming a file invalidates everything
+ cached in its folder. A file edited in place doesn't change its
+ folder's time, so cached stats are also only trusted for
+ file_stat_seconds ; and umber's own writes call forget(), which
+ also touches the folder so that the other server processes see it.
+
+   >>> import tempfile
+   >>> folder = tempfile.mkdtemp()
+   >>> path = os.path.join(folder, 'hello.md')
+   >>> (exists(path), isfile(path), isdir(folder))
+   (False, False, True)
+   >>> with open(path, 'w') as file:
+   ...     count = file.write('hello')
+   >>> forget(path)
+   >>> (exists(path), isfile(path), stat(path).st_size)
+   (True, True, 5)
+   >>> listdir(folder)
+   ['hello.md']
+   >>> shutil.rmtree(folder)
+"""
+import os, stat as _stat, shutil
+from time import time
+from settings import file_stat_seconds, file_stat_cache_size
+
+_files = {}      # {abspath: (os.stat_result or None, folder mtime, when)}
+_folders = {}    # {folder abspath: (mtime or None, request number, when)}
+_listings = {}   # {folder abspath: (mtime, sorted names)}
+_request = 0     # incremented by new_request()
+
+def new_request():
+    """ Start a new request : folder times will be checked again. """
+    global _request
+    _request += 1
+
+def request_number():
+    """ Return a number which is different for each request """
+    return _request
+
+def remember(cache, key, value):
+    """ Set cache[key] = value, first emptying the cache if it's full """
+    if len(cache) >= file_stat_cache_size and key not in cache:
+        cache.clear()
+    cache[key] = value
+
+def _folder_of(abspath):
+    """ Return the enclosing folder of a file or folder path """
+    return os.path.dirname(abspath.rstrip('/')) or '/'
+
+def _folder_mtime(folder):
+    """ Return modification time of a folder (in ns) or None if missing """
+    seen = _folders.get(folder)
+    if seen and seen[1] == _request and time() - seen[2] < file_stat_seconds:
+        return seen[0]
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+    except OSError:
+        mtime = None
+    remember(_folders, folder, (mtime, _request, time()))
+    return mtime
+
+def stat(abspath):
+    """ Return os.stat_result for a path, or None if it doesn't exist """
+    folder_mtime = _folder_mtime(_folder_of(abspath))
+    entry = _files.get(abspath)
+    if entry and entry[1] == folder_mtime and \
+       time() - entry[2] < file_stat_seconds:
+        return entry[0]
+    try:
+        result = os.stat(abspath)
+    except OSError:
+        result = None
+    remember(_files, abspath, (result, folder_mtime, time()))
+    return result
+
+def exists(abspath):
+    return stat(abspath) is not None
+
+def isfile(abspath):
+    result = stat(abspath)
+    return result is not None and _stat.S_ISREG(result.st_mode)
+
+def isdir(abspath):
+    result = stat(abspath)
+    return result is not None and _stat.S_ISDIR(result.st_mode)
+
+def listdir(folder):
+    """ Return sorted names in a folder, like sorted(os.listdir(folder)).
+        Raises OSError if the folder doesn't exist. """
+    # The listing is cached until the folder's time changes ;
+    # while reading it, the stat of each file is cached too,
+    # so that the Page objects for a folder's children are cheap.
+    folder = folder.rstrip('/') or '/'
+    mtime = _folder_mtime(folder)
+    if mtime is None:
+        raise FileNotFoundError(folder)
+    listing = _listings.get(folder)
+    if listing and listing[0] == mtime:
+        return list(listing[1])
+    names = []
+    now = time()
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            names.append(entry.name)
+            try:
+                remember(_files, entry.path, (entry.stat(), mtime, now))
+            except OSError:
+                pass
+    names.sort()
+    remember(_listings, folder, (mtime, names))
+    return list(names)
+
+def forget(abspath, touch=True):
+    """ Drop cached data for a path that umber has just written,
+        created or deleted. Also (by default) touch its folder,
+        so that other processes' cached data will be refreshed. """
+    stripped = abspath.rstrip('/')
+    for key in (abspath, stripped, stripped + '/'):
+        _files.pop(key, None)
+        _listings.pop(key, None)
+    folder = _folder_of(abspath)
+    if touch:
+        try:
+            os.utime(folder)
+        except OSError:
+            pass
+    _folders.pop(folder, None)
+    _listings.pop(folder, None)
+
+def clear():
+    """ Forget everything """
+    _files.clear()
+    _folders.clear()
+    _listings.clear()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
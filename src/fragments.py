@@ -0,0 +1,96 @@
+"""
+ fragments.py
+
+ A jinja2 extension for caching the output of parts of templates,
+ for the parts that are the same for every viewer with the same role
+ in a course. In a template,
+
+    {%- cache 'footer', g.now.isodate() %}
+      ...
+    {%- endcache %}
+
+ renders its body once for each value of the keys after the name,
+ and after that reuses the html. So the keys must include everything
+ that the body depends on : e.g. the course's snapshot generation,
+ the user's role rank, the page url. Editing the template (which
+ recompiles it) also starts over.
+
+ The html is kept in this process (each uwsgi worker has its own),
+ with least recently used fragments dropped beyond fragment_cache_size.
+ Hits and misses per fragment name are shown on the sys/timing page.
+
+   >>> from jinja2 import Environment
+   >>> env = Environment(extensions=[FragmentCache])
+   >>> template = env.from_string(
+   ...     "{% cache 'test', x %}{{ x }} {{ y }}{% endcache %}")
+   >>> (template.render(x=1, y=2), template.render(x=1, y=3))
+   ('1 2', '1 2')
+   >>> template.render(x=2, y=3)
+   '2 3'
+   >>> summary()['test']
+   {'hits': 1, 'misses': 2, 'hit_rate': 0.33}
+   >>> reset()
+"""
+from time import time
+from collections import OrderedDict
+from jinja2 import nodes
+from jinja2.ext import Extension
+from settings import fragment_cache_size
+
+_fragments = OrderedDict()   # {(name, compiled, keys): html}, oldest first
+_counts = {}                 # {name: {'hits': n, 'misses': n}}
+
+class FragmentCache(Extension):
+    """ {% cache name, key, ... %} ... {% endcache %} """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        # Different each time the template is compiled.
+        compiled = nodes.Const('{} {}'.format(parser.name, time()))
+        return nodes.CallBlock(
+            self.call_method('_cached', [compiled, nodes.List(args)]),
+            [], [], body).set_lineno(lineno)
+
+    def _cached(self, compiled, args, caller):
+        (name, keys) = (args[0], tuple(args[1:]))
+        return fragment(name, (compiled,) + keys, caller)
+
+def fragment(name, keys, render):
+    """ Return render() for this fragment, or its cached html """
+    count = _counts.setdefault(name, {'hits': 0, 'misses': 0})
+    key = (name, keys)
+    html = _fragments.get(key)
+    if html is None:
+        count['misses'] += 1
+        html = render()
+        _fragments[key] = html
+        while len(_fragments) > fragment_cache_size:
+            _fragments.popitem(last=False)
+    else:
+        count['hits'] += 1
+        _fragments.move_to_end(key)
+    return html
+
+def summary():
+    """ Return {name: {'hits', 'misses', 'hit_rate'}} for this process """
+    data = {}
+    for name in sorted(_counts):
+        (hits, misses) = (_counts[name]['hits'], _counts[name]['misses'])
+        data[name] = {'hits': hits, 'misses': misses,
+                      'hit_rate': round(hits / (hits + misses), 2)
+                                  if hits + misses else 0}
+    return data
+
+def reset():
+    """ Forget all cached fragments and counts """
+    _fragments.clear()
+    _counts.clear()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -26,6 +26,8 @@
 """
 
 from utilities import print_debug
+import filestat
+import os
 from os import getpid
 from time import sleep
 from shlex import quote
@@ -78,6 +80,10 @@ def run(*commands, timeout=1.0, verbose=True, attempt=0):
     return retry
 
 system_username = '__system__'
+
+# Functions called as function(course, abspaths) after each commit,
+# with the files or folders that it added or removed ; see pagecache.py.
+commit_hooks = []
     
 def _git_(command, course=None, page=None, user=None, abspath=None):
     """ Run a sequence of git command strings 
@@ -97,11 +103,16 @@ def _git_(command, course=None, page=None, user=None, abspath=None):
     print_debug(f" _git_ : git_command='{git_command}' git_commit='{git_commit}'")
     if command == 'init':
         run(git_command, f'/bin/git -C {repo} add .', git_commit)
+        abspaths = [course.abspath]
     elif command == 'rm -r':
         git_command.append(git_commit)
         run(*git_command)
+        abspaths = abspath
     else:
         run(git_command, git_commit)
+        abspaths = [abspath or page.abspath]
+    for hook in commit_hooks:
+        hook(course, abspaths)
 
 def init_add_commit(course, user):
     """ Create a new .git repo in a course, add its files, and commit. """
@@ -114,9 +125,32 @@ def add_commit(page, abspath=None):
 def rms_commit(page, abspaths):
     """ Remove a list of files from a course's git repo, and commit. """
     _git_('rm -r', course=page.course, page=page, user=page.user, abspath=abspaths)
+    for abspath in abspaths:
+        filestat.forget(abspath)
+
+_histories = {}   # {(repo, path): (stat of .git/logs/HEAD, log)}
 
 def get_history(page):
     """ Get a file's git log, returning [(revision, date, author),... ] """
+    # Each commit appends to the repo's .git/logs/HEAD, so a file's
+    # log can be reused until that changes.
+    try:
+        head = os.stat(os.path.join(page.course.abspath, '.git', 'logs', 'HEAD'))
+        head = (head.st_ino, head.st_size, head.st_mtime_ns)
+    except OSError:
+        head = None
+    cache_key = (page.course.abspath, page.get_gitpath())
+    cached = _histories.get(cache_key)
+    if head and cached and cached[0] == head:
+        return list(cached[1])
+    log = _get_history(page)
+    if len(_histories) > 1000:
+        _histories.clear()
+    _histories[cache_key] = (head, tuple(log))
+    return log
+
+def _get_history(page):
+    """ Get a file's git log from git """
     path = quote(page.get_gitpath())
     repo = quote(page.course.abspath)
     format = """--pretty=format:'{"commit":"%H", "date":"%aI", "msg": "%s"},'"""
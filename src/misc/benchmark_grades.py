@@ -0,0 +1,115 @@
+"""
+ benchmark_grades.py
+
+ Check that Work.grade_css (all of a gradebook's cells at once, from
+ their *_epoch columns) gives the same grades and colors as the older
+ one-cell-at-a-time Work.get_grade_css (copied below), for a made up
+ gradebook of 100 students by 40 assignments, and time both.
+
+   $ cd src ; python3 misc/benchmark_grades.py
+
+ No database is needed ; the Work and Assignment objects aren't saved.
+"""
+import sys, os, random
+from time import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from settings import due_grace_hours
+from utilities import Time
+from model import Work, Assignment, epoch_of
+
+# ---- the older version -------------------------------------------
+
+def old_grade_css(work, faculty_view):
+    css_class = 'black'
+    duedate = Time(work.assignment.due)
+    duedate.arrow = duedate.arrow.shift(hours=due_grace_hours)
+    now = Time()
+    before_due_date = now < duedate
+    faculty_modified = work.faculty_modified or '1901'
+    faculty_seen = work.faculty_seen or '1901'
+    student_modified = work.student_modified or '1901'
+    student_seen = work.student_seen or '1901'
+    if faculty_view:
+        if Time(faculty_modified) > Time(student_seen):
+            css_class = 'brown'
+        if Time(student_modified) > Time(faculty_seen):
+            css_class = 'darkgreen'
+        if not work.submitted:
+            if before_due_date:
+                grade = '…'
+            else:
+                grade = 'overdue'
+                css_class = 'red'
+        else:
+            if not work.grade:
+                grade = 'ungraded'
+                css_class = 'green'
+            else:
+                grade = work.grade
+    else:
+        if Time(student_modified) > Time(faculty_seen):
+            css_class = 'brown'
+        if Time(faculty_modified) > Time(student_seen):
+            css_class = 'darkgreen'
+        if not work.submitted:
+            if before_due_date:
+                grade = '…'
+            else:
+                grade = 'l͟a͟t͟e͟'
+                css_class = 'green'
+        else:
+            if not work.grade:
+                grade = 'ungraded'
+                css_class = 'brown'
+            else:
+                grade = work.grade
+    if work.grade:
+        grade = work.grade
+    return (grade, css_class)
+
+# ---- the gradebook -------------------------------------------------
+
+def gradebook(students=100, assignments=40, seed=1):
+    """ Return a list of unsaved Work, as if read from the database """
+    rand = random.Random(seed)
+    now = int(Time().epoch)
+    day = 24 * 3600
+    def when(start, end):
+        return str(Time(rand.randint(start, end)))
+    asses = []
+    for nth in range(assignments):
+        # past and future due dates, a few blank
+        due = '' if rand.random() < 0.05 else when(now - 60*day, now + 30*day)
+        asses.append(Assignment(nth=nth + 1, due=due,
+                                due_epoch=epoch_of(due)))
+    works = []
+    for person in range(students):
+        for ass in asses:
+            start = now - 90*day
+            fields = {name: (when(start, now) if rand.random() < 0.6 else '')
+                      for name in Work._epoch_fields}
+            fields['grade'] = rand.choice(('', '', 'A', 'B+', 'C'))
+            work = Work(assignment=ass, notes='', **fields)
+            for (field, epoch_field) in Work._epoch_fields.items():
+                setattr(work, epoch_field, epoch_of(fields[field]))
+            works.append(work)
+    return works
+
+if __name__ == '__main__':
+    works = gradebook()
+    print(' {} cells'.format(len(works)))
+    for faculty_view in (True, False):
+        start = time()
+        old = [old_grade_css(work, faculty_view) for work in works]
+        old_seconds = time() - start
+        start = time()
+        single = [work.get_grade_css(faculty_view) for work in works]
+        single_seconds = time() - start
+        start = time()
+        batch = Work.grade_css(Work.grade_columns(works), faculty_view)
+        batch_seconds = time() - start
+        print(' faculty_view={} : {} differ ; old {:.3f}s, get_grade_css'
+              ' {:.3f}s, grade_css {:.4f}s'.format(
+                  faculty_view,
+                  sum(o != s or o != b for (o, s, b) in zip(old, single, batch)),
+                  old_seconds, single_seconds, batch_seconds))
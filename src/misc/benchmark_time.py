@@ -0,0 +1,173 @@
+"""
+ benchmark_time.py
+
+ Check that utilities.Time (seconds since 1970, with a memo of parsed
+ database strings) gives the same results as the older arrow version
+ (copied below) for many made up times - across daylight savings
+ changes, at the default 23:59:00, from os.stat timestamps, and from
+ human-ish strings - and time both.
+
+   $ cd src ; python3 misc/benchmark_time.py
+"""
+import sys, os, re, random
+from time import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import arrow
+from settings import localtimezone
+from utilities import Time, is_number, is_iso_utc
+
+# ---- the older version -------------------------------------------
+
+class OldTime:
+
+    def __init__(self, datetimestring=None):
+        try:
+            if is_number(datetimestring):
+                self.arrow = arrow.Arrow.fromtimestamp(datetimestring)
+            elif datetimestring == None or datetimestring == '':
+                self.arrow = arrow.get()
+            elif is_iso_utc(datetimestring):
+                self.arrow = arrow.get(datetimestring)
+            else:
+                parsed = Time._parse(datetimestring)
+                parsed = re.sub(r'\.\d+', '', parsed)
+                self.arrow = arrow.get(parsed)
+        except:
+            self.arrow = arrow.get()
+        local_arrow = self.arrow.replace(tzinfo=localtimezone)
+        if not Time.default24time in local_arrow.isoformat():
+            offset = self.arrow - local_arrow
+            self.arrow = local_arrow + offset
+        else:
+            self.arrow = local_arrow
+
+    def __lt__(self, other):
+        return self.arrow < other.arrow
+    def __eq__(self, other):
+        return self.arrow == other.arrow
+    def __str__(self):
+        return self.arrow.floor('second').isoformat()
+    def date(self):
+        return self.arrow.format('MMMM DD YYYY')
+    def isodate(self):
+        return self.arrow.format('YYYY-MM-DD')
+    def daydatetime(self):
+        return self.arrow.format('ddd MMMM D YYYY h:mm a')
+    def datetime(self):
+        return self.arrow.format('ddd MMM DD YYYY hh:mm a')
+    def daydatetimesec(self):
+        return self.arrow.format('ddd MMM DD YYYY hh:mm:ss a')
+    def slashes(self):
+        return self.arrow.format('MM/DD/YY')
+    def assigndate(self):
+        datetime = self.arrow.format('ddd MMM D h:mm a')
+        if Time.defaulttime in datetime:
+            return self.arrow.format('ddd MMM D')
+        else:
+            return datetime
+    def assignISOdate(self):
+        datetime = self.arrow.format('YYYY-MM-DD h:mm a')
+        if Time.defaulttime in datetime:
+            return self.arrow.format('YYYY-MM-DD')
+        else:
+            return datetime
+    def semester(self):
+        month = self.arrow.month
+        if month < 6:
+            season = 'Spring '
+        elif month < 9:
+            season = 'Summer '
+        else:
+            season = 'Fall '
+        return season + str(self.arrow.year)
+    def shift_minutes(self, mins):
+        self.arrow = self.arrow.shift(minutes=mins)
+        return self
+
+methods = ('__str__', 'date', 'isodate', 'daydatetime', 'datetime',
+           'daydatetimesec', 'slashes', 'assigndate', 'assignISOdate',
+           'semester')
+
+# ---- the times ---------------------------------------------------
+
+def made_up_times(count, seed=1):
+    """ Return a list of ISO strings, timestamps, and human-ish strings """
+    rand = random.Random(seed)
+    times = []
+    for i in range(count):
+        year = rand.choice((2013, 2018, 2020, 2021, 2024))
+        # Around the March and November daylight savings changes,
+        # or anywhere in the year.
+        (month, day) = rand.choice(((3, rand.randint(7, 15)),
+                                    (11, rand.randint(1, 8)),
+                                    (rand.randint(1, 12), rand.randint(1, 28))))
+        (hour, minute, second) = rand.choice(
+            ((23, 59, 0), (rand.randint(0, 3), rand.randint(0, 59), 0),
+             (rand.randint(0, 23), rand.randint(0, 59), rand.randint(0, 59))))
+        offset = rand.choice(('+00:00', '-04:00', '-05:00', '+05:30'))
+        iso = '{}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}'.format(
+            year, month, day, hour, minute, second)
+        kind = rand.randint(0, 9)
+        if kind < 6:
+            times.append(iso + offset)
+        elif kind < 7:
+            times.append(iso + '.{:06d}'.format(rand.randint(0, 999999)) + offset)
+        elif kind < 9:
+            times.append(arrow.get(iso + offset).float_timestamp)
+        else:
+            times.append('{}-{:02d}-{:02d}'.format(year, month, day))
+    return times
+
+# ---- compare and time ------------------------------------------------
+
+def compare(times):
+    differ = []
+    for when in times:
+        (old, new) = (OldTime(when), Time(when))
+        for method in methods:
+            if getattr(old, method)() != getattr(new, method)():
+                differ.append((when, method, getattr(old, method)(),
+                               getattr(new, method)()))
+        (old, new) = (old.shift_minutes(90), new.shift_minutes(90))
+        if str(old) != str(new):
+            differ.append((when, 'shift_minutes', str(old), str(new)))
+    for (a, b) in zip(times, times[1:]):
+        if (OldTime(a) < OldTime(b)) != (Time(a) < Time(b)) or \
+           (OldTime(a) == OldTime(b)) != (Time(a) == Time(b)):
+            differ.append((a, 'compare ' + str(b), '', ''))
+    return differ
+
+def seconds(function, times, repeats):
+    start = time()
+    for i in range(repeats):
+        for when in times:
+            function(when)
+    return time() - start
+
+def benchmark(times, repeats=5):
+    print(' {:28} {:>9} {:>9}'.format('', 'old', 'new'))
+    database = [when for when in times
+                if not is_number(when) and is_iso_utc(when)]
+    for (what, function, inputs) in (
+            ('Time(database string)', lambda cls: lambda when: cls(when), database),
+            ('Time(timestamp)', lambda cls: lambda when: cls(when),
+                 [when for when in times if is_number(when)]),
+            ('Time(database string) < ...',
+                 lambda cls: lambda when: cls(when) < cls(database[0]), database),
+            ('.daydatetime()',
+                 lambda cls: lambda when: cls(when).daydatetime(), database),
+            ('str()', lambda cls: lambda when: str(cls(when)), database)):
+        old = seconds(function(OldTime), inputs, repeats)
+        Time._memo.clear()
+        new = seconds(function(Time), inputs, repeats)
+        count = repeats * len(inputs)
+        print(' {:28} {:8.1f}us {:8.1f}us'.format(
+            what, 1e6 * old / count, 1e6 * new / count))
+
+if __name__ == '__main__':
+    times = made_up_times(2000)
+    differ = compare(times)
+    print(' compared {} times : {} differ'.format(len(times), len(differ)))
+    for (when, method, old, new) in differ[:20]:
+        print('   {!r} {} : {!r} {!r}'.format(when, method, old, new))
+    benchmark(times)
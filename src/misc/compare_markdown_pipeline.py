@@ -0,0 +1,160 @@
+"""
+ compare_markdown_pipeline.py
+
+ Check that the one-pass link_translate, mathjax_replace and href
+ fix-up in utilities.py give the same html as the older versions
+ (copied below) for every .md file in os_courses and some made up
+ pages, and time both on large math-heavy pages.
+
+   $ cd src ; python3 misc/compare_markdown_pipeline.py
+
+ (The older mathjax_replace did one kind of delimiter at a time,
+ so they may differ when spans of different kinds overlap,
+ e.g. "\( a $$ b \) c $$" ; the new one scans left to right.)
+"""
+import sys, os, re, random
+from time import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from markdown2 import markdown
+from settings import os_courses, url_base
+import utilities
+
+# ---- the older versions ------------------------------------------
+
+def old_link_translate(course_url, html):
+    if course_url[-1] == '/':
+        course_url_with_slash = course_url
+    else:
+        course_url_with_slash = course_url + '/'
+    html = html.replace('(~~/', '(/' + url_base + r'/')
+    html = html.replace('(~/', '(' + course_url_with_slash)
+    return html
+
+def make_marker(bits=64):
+    return '|-'+hex(random.getrandbits(64))[2:-1]+'-|'
+
+def old_mathjax_replace(text):
+    replacements = {}
+    for expr in (r'\$\$.*?\$\$',       #   $$ ... $$
+                 r'\\\(.*?\\\)',       #   \( ... \)
+                 r'\\\[.*?\\\]'):      #   \[ ... \]
+        pattern = re.compile(expr)
+        while True:
+            match = re.search(pattern, text)
+            if not match:
+                break
+            substring = match.group(0)
+            m = make_marker()
+            replacements[m] = substring
+            text = text.replace(substring, m)
+    return (text, replacements)
+
+def old_undo_mathjax_replace(text, replacements):
+    for mark in replacements:
+        text = text.replace(mark, replacements[mark])
+    return text
+
+def old_markdown2html(string):
+    (string, replacements) = old_mathjax_replace(string)
+    output = markdown(string,
+                      extras=['code-friendly', 'fenced-code-blocks',
+                              'footnotes', 'pyshell', 'tables',
+                              'cuddled-lists', 'markdown-in-html'])
+    output = old_undo_mathjax_replace(output, replacements)
+    href_amp = re.compile(r'href=([^\s>]*)&amp;')
+    href_semi = re.compile(r'href=([^\s>]*);')
+    while re.search(href_amp, output):
+        output = re.sub(href_amp, r'href=\1&', output)
+    while re.search(href_semi, output):
+        output = re.sub(href_semi, r'href=\1', output)
+    return output
+
+# ---- the pages ---------------------------------------------------
+
+class FakeCourse:
+    def __init__(self, url):
+        self.url = url
+
+def course_pages():
+    """ Return {name: markdown} for the .md files in os_courses """
+    pages = {}
+    for (dirpath, dirnames, filenames) in os.walk(os_courses):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for name in filenames:
+            if name.endswith('.md'):
+                path = os.path.join(dirpath, name)
+                with open(path, 'rb') as _file:
+                    pages[os.path.relpath(path, os_courses)] = \
+                        _file.read().decode('utf8')
+    return pages
+
+def math_page(formulas):
+    """ Return a made up page with this many formulas, and some links """
+    lines = ['# notes', '']
+    for i in range(formulas):
+        lines.append(('Step {0} : $$ x_{0} = \\frac{{{0}}}{{y}} $$ so'
+                      ' \\( a_{0} \\le b \\) and \\[ \\sum_{{i<{0}}} i \\] ;'
+                      ' see [this](~/notes/{0}?a=1&b={0}) or'
+                      ' [that](~~/umber/docs/{0}).').format(i))
+        if i % 10 == 0:
+            lines += ['', '    code $$ not_math(~/x) $$', '']
+    return '\n'.join(lines)
+
+def made_up_pages():
+    return {'empty': '',
+            'plain': 'Just *some* text, with $ 5 and ~/ and (~ / here.',
+            'repeats': 'a $$x$$ b $$x$$ c \\(y\\) d \\(y\\) $$x$$',
+            'unclosed': 'a $$ b \\( c \\[ d',
+            'multiline': '$$\nnot one line\n$$ but $$one$$',
+            'links': '[a](~/a?x=1&y=2) [b](~~/b;c) <a href="x&amp;amp;y">',
+            'math100': math_page(100),
+            'math1000': math_page(1000)}
+
+# ---- compare and time ------------------------------------------------
+
+def html_or_error(markdown2html, text):
+    # (Both raise the same errors, e.g. from a pygments
+    #  that doesn't match markdown2's version.)
+    try:
+        return markdown2html(text)
+    except Exception as error:
+        return 'error : ' + repr(error)
+
+def compare(pages):
+    differ = []
+    for (name, text) in sorted(pages.items()):
+        for url in ('http://127.0.0.1:5000/courses/demo',
+                    'http://127.0.0.1:5000/courses/umber/'):
+            new = utilities.link_translate(FakeCourse(url), text)
+            if new != old_link_translate(url, text):
+                differ.append(('link_translate', name))
+        if (html_or_error(utilities.markdown2html, text) !=
+            html_or_error(old_markdown2html, text)):
+            differ.append(('markdown2html', name))
+    return differ
+
+def seconds(function, *args):
+    start = time()
+    function(*args)
+    return time() - start
+
+def benchmark():
+    print(' {:>9} {:>10} {:>10} {:>10} {:>10}'.format(
+        'formulas', 'old math', 'new math', 'old html', 'new html'))
+    for formulas in (100, 1000, 4000):
+        text = math_page(formulas)
+        print(' {:9} {:9.3f}s {:9.3f}s {:9.3f}s {:9.3f}s'.format(
+            formulas,
+            seconds(old_mathjax_replace, text),
+            seconds(utilities.mathjax_replace, text),
+            seconds(old_markdown2html, text),
+            seconds(utilities.markdown2html, text)))
+
+if __name__ == '__main__':
+    pages = course_pages()
+    pages.update(made_up_pages())
+    differ = compare(pages)
+    print(' compared {} pages : {} differ'.format(len(pages), len(differ)))
+    for (what, name) in differ:
+        print('   {} : {}'.format(what, name))
+    benchmark()
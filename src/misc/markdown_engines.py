@@ -0,0 +1,160 @@
+"""
+ markdown_engines.py
+
+ Compare the markdown engines in utilities.markdown_engines
+ (see settings.markdown_engine) against golden html from markdown2,
+ on the courses/demo pages, the site docs, and a small page for each
+ markdown2 extra that umber uses.
+
+   $ cd src
+   $ python3 misc/markdown_engines.py golden /tmp/corpus   # save markdown2 html
+   $ python3 misc/markdown_engines.py compare /tmp/corpus  # differences
+   $ python3 misc/markdown_engines.py benchmark            # pages/second
+
+ "compare" counts, for each engine and feature, the pages using that
+ feature whose html is identical to the golden html, has the same text
+ (i.e. differs only in tags or whitespace), or differs. Engines that
+ aren't installed are skipped.
+"""
+import sys, os, re
+from time import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bs4 import BeautifulSoup
+from settings import os_courses
+from utilities import markdown2html, markdown_engines
+
+# feature : (regex that finds it in markdown, a small page using it)
+features = {
+    'fenced code':  (r'^```',
+                     'Some code :\n\n```python\ndef f(x):\n    return x\n```\n'),
+    'footnotes':    (r'\[\^[^\]]+\]',
+                     'A claim.[^1]\n\n[^1]: The source.\n'),
+    'tables':       (r'^\s*\|?\s*:?-{3,}:?\s*\|',
+                     '| a | b |\n|---|---|\n| 1 | 2 |\n'),
+    'pyshell':      (r'^>>> ',
+                     'In python :\n\n>>> 1 + 1\n2\n'),
+    'markdown-in-html': (r'markdown=.?1',
+                     '<div markdown="1">\n*emphasis* inside\n</div>\n'),
+    'cuddled lists': (r'^[^\s*+\-].*\n[*+\-] ',
+                     'A list :\n- one\n- two\n'),
+    'code-friendly': (r'\w_\w+_',
+                     'Call some_long_name or __init__ here.\n'),
+    'math':         (r'\$\$|\\\(|\\\[',
+                     'So $$ a_1 * b_2 $$ and \\( x_1 * y_2 \\) .\n'),
+    }
+
+def corpus():
+    """ Return {name: markdown} for demo, the site docs, and features """
+    pages = {}
+    for folder in ('demo', os.path.join('umber', 'docs')):
+        top = os.path.join(os_courses, folder)
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.endswith('.md'):
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, os_courses)[:-3]
+                    with open(path, 'rb') as _file:
+                        pages[name.replace(os.sep, '__')] = \
+                            _file.read().decode('utf8')
+    for (feature, (regex, sample)) in features.items():
+        pages['feature__' + feature.replace(' ', '_')] = sample
+    return pages
+
+def page_features(markdown):
+    """ Return the features that a page uses """
+    return [feature for (feature, (regex, sample)) in features.items()
+            if re.search(regex, markdown, re.MULTILINE)] or ['plain']
+
+def render(markdown, engine):
+    """ Return html, or 'error : ...' """
+    try:
+        return markdown2html(markdown, engine=engine)
+    except ImportError:
+        raise
+    except Exception as error:
+        return 'error : ' + repr(error)
+
+def installed_engines():
+    engines = []
+    for engine in markdown_engines:
+        try:
+            markdown2html('', engine=engine)
+            engines.append(engine)
+        except ImportError:
+            print(' ({} is not installed)'.format(engine))
+    return engines
+
+def text_of(html):
+    return ' '.join(BeautifulSoup(html, 'html.parser').get_text().split())
+
+def golden(folder):
+    os.makedirs(folder, exist_ok=True)
+    pages = corpus()
+    for (name, markdown) in pages.items():
+        for (extension, content) in (('.md', markdown),
+                                     ('.html', render(markdown, 'markdown2'))):
+            with open(os.path.join(folder, name + extension), 'wb') as _file:
+                _file.write(content.encode('utf8'))
+    print(' wrote {} golden pages to {}'.format(len(pages), folder))
+
+def compare(folder):
+    pages = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith('.md'):
+            with open(os.path.join(folder, filename), 'rb') as _file:
+                markdown = _file.read().decode('utf8')
+            with open(os.path.join(folder, filename[:-3] + '.html'),
+                      'rb') as _file:
+                pages[filename[:-3]] = (markdown, _file.read().decode('utf8'))
+    print(' {} golden pages in {}'.format(len(pages), folder))
+    for engine in installed_engines():
+        counts = {}     # {feature: {'identical': n, 'same text': n, 'differ': n}}
+        differ = []
+        for (name, (markdown, expected)) in pages.items():
+            html = render(markdown, engine)
+            if html == expected:
+                result = 'identical'
+            elif text_of(html) == text_of(expected):
+                result = 'same text'
+            else:
+                result = 'differ'
+                differ.append(name)
+            for feature in page_features(markdown):
+                count = counts.setdefault(feature, {'identical': 0,
+                                                    'same text': 0,
+                                                    'differ': 0})
+                count[result] += 1
+        print()
+        print(' {}'.format(engine))
+        print('   {:18} {:>9} {:>9} {:>9}'.format(
+            'feature', 'identical', 'same text', 'differ'))
+        for feature in sorted(counts):
+            count = counts[feature]
+            print('   {:18} {:9} {:9} {:9}'.format(feature, count['identical'],
+                                          count['same text'], count['differ']))
+        for name in sorted(differ):
+            print('   differs : {}'.format(name))
+
+def benchmark(repeats=5):
+    pages = list(corpus().values())
+    print(' {} pages, {} times each'.format(len(pages), repeats))
+    for engine in installed_engines():
+        start = time()
+        for i in range(repeats):
+            for markdown in pages:
+                render(markdown, engine)
+        seconds = time() - start
+        print('   {:12} {:8.1f} pages/second'.format(
+            engine, repeats * len(pages) / seconds))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) == 2 and args[0] == 'golden':
+        golden(args[1])
+    elif len(args) == 2 and args[0] == 'compare':
+        compare(args[1])
+    elif args == ['benchmark']:
+        benchmark()
+    else:
+        print(' usage: markdown_engines.py golden FOLDER | compare FOLDER | benchmark')
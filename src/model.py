@@ -52,28 +52,57 @@
  Jim Mahoney | mahoney@marlboro.edu | MIT License
 """
 
-import os, yaml, re, mimetypes, shutil, random
-from functools import reduce
+import os, yaml, re, mimetypes, shutil, random, ast
+from contextlib import contextmanager
+from types import MappingProxyType
+from time import time
+from stat import S_ISREG, S_ISDIR
 from flask import url_for
 from werkzeug.security import generate_password_hash, check_password_hash
 from peewee import ( SqliteDatabase, Model, TextField, IntegerField,
-                     PrimaryKeyField, ForeignKeyField )
+                     PrimaryKeyField, ForeignKeyField, fn, chunked,
+                     DatabaseError )
 from bs4 import BeautifulSoup
 from utilities import ( markdown2html, link_translate, static_url, md5, Time,
                         ext_to_filetype, filetype_to_icon, size_in_bytes,
-                        stringify_access, print_debug, clean_access_dict )
+                        stringify_access, print_debug, clean_access_dict,
+                        pygmentize, lexer_name )
 from settings import ( os_db, umber_url, protocol, hostname, umber_mime_types,
                        os_root, os_courses, photos_url, url_base,
                        os_default_course, site_course_path, site_home,
-                       due_grace_hours )
-import gitlocal
-
-db = SqliteDatabase(os_db)
+                       due_grace_hours, file_stat_seconds, umber_debug )
+import gitlocal, timing, filestat, rendercache, seen
+
+class UmberDatabase(SqliteDatabase):
+    """ sqlite3 database which counts its queries ; see timing.py """
+    def execute_sql(self, *args, **kwargs):
+        timing.count_query()
+        return super().execute_sql(*args, **kwargs)
+
+db = UmberDatabase(os_db)
+
+def epoch_of(when):
+    """ Return a database time string as integer seconds since 1970,
+        or 0 if it's blank.
+        >>> epoch_of('2018-01-22T18:20:23-05:00')
+        1516663223
+        >>> epoch_of('')
+        0
+    """
+    return int(Time(when).epoch) if when else 0
 
 class BaseModel(Model):
     class Meta:
         database = db   # (peewee requires this 'database' name)
 
+    # {time string field: its integer *_epoch field}, set by save()
+    _epoch_fields = {}
+
+    def save(self, *args, **kwargs):
+        for (field, epoch_field) in self._epoch_fields.items():
+            setattr(self, epoch_field, epoch_of(getattr(self, field)))
+        return super().save(*args, **kwargs)
+
     def __repr__(self):
         # e.g. 
         fields = ', '.join(["{}={}".format(x[0],repr(x[1]))
@@ -88,6 +117,69 @@ class BaseModel(Model):
     @classmethod
     def all(cls):
         return list(cls.select().execute())
+
+    def copy(self):
+        """ Return a separate instance of this same row """
+        duplicate = type(self)(__no_default__=1, **self.__data__)
+        duplicate._dirty.clear()
+        return duplicate
+
+class Generation(BaseModel):
+    """ A counter for data which each server process caches in memory,
+        so that a change made by one process is seen by the others.
+        Values come from one sequence shared by all the names ;
+        refresh() (once per request) fetches only the rows
+        changed since the last look. See database/umber.sql . """
+    class Meta:
+        db_table = 'Generation'
+
+    name = TextField(primary_key=True)
+    value = IntegerField(index=True)
+
+    _seen = {}     # {name: value} as of the last refresh() or bump()
+    _latest = 0    # largest value read by refresh()
+    _watchers = {} # {kind: [function(name), ...]} ; see watch()
+
+    @staticmethod
+    def refresh():
+        """ Read the generations that changed since the last refresh """
+        rows = (Generation.select(Generation.name, Generation.value)
+                          .where(Generation.value > Generation._latest)
+                          .tuples())
+        for (name, value) in rows:
+            if Generation._seen.get(name) != value:
+                Generation._seen[name] = value
+                Generation._notify(name)
+            Generation._latest = max(Generation._latest, value)
+
+    @staticmethod
+    def current(name):
+        """ Return the current generation of some cached data, or 0 """
+        return Generation._seen.get(name, 0)
+
+    @staticmethod
+    def bump(name):
+        """ Mark some cached data as changed, in all processes """
+        # An immediate transaction so that two processes can't
+        # both take the same next value.
+        with db.atomic('IMMEDIATE'):
+            latest = Generation.select(fn.MAX(Generation.value)).scalar() or 0
+            (Generation.insert(name=name, value=latest + 1)
+                       .on_conflict_replace().execute())
+        Generation._seen[name] = latest + 1
+        Generation._notify(name)
+
+    @staticmethod
+    def watch(kind, function):
+        """ Call function(name) whenever a generation of this kind
+            changes, in this process or (at the next refresh) another.
+            The kind of e.g. 'course-3' is 'course'. """
+        Generation._watchers.setdefault(kind, []).append(function)
+
+    @staticmethod
+    def _notify(name):
+        for function in Generation._watchers.get(name.split('-')[0], ()):
+            function(name)
     
 class Person(BaseModel):
     class Meta:
@@ -155,13 +247,16 @@ class Person(BaseModel):
     def course_data(self):
         """ return courses that this person is registered in 
             as a dict with keys role,course,url,semester """
-        registrations = list(Registration.select()
+        registrations = list(Registration.select(Registration, Course, Role)
+                                         .join(Course)
+                                         .switch(Registration)
+                                         .join(Role)
                                          .where(Registration.person == self))
         registrations.sort(key=lambda r: r.course.name)
         registrations.sort(key=lambda r: r.course.start_date, reverse=True)
         return [{'role':r.role.name,
                  'course':r.course.name,
-                 'url':r.course.url,
+                 'url':umber_url + '/' + r.course.path,
                  'semester':Time(r.course.start_date).semester()}
                for r in registrations if not r.course.name == 'Umber']
 
@@ -175,6 +270,7 @@ class Person(BaseModel):
             site_registration = Registration.get(course=umber, person=self)
             site_registration.role = Role.by_name('admin')
             site_registration.save()
+        umber._changed()
     
     def works(self, course):
         query = (Work.select()
@@ -184,12 +280,23 @@ class Person(BaseModel):
 
     def _save(self):
         """ save to database and invalidate caches """
-        try:
-            del Person._by_username[self.username]
-        except KeyError:
-            pass
-        Person._admins = None
         self.save()
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        # Tell all processes to forget their cached copies ; see _uncache().
+        # (One generation for everyone, rather than one per person, so
+        # that the Generation table doesn't grow with each new person.
+        # People are saved rarely, e.g. when created or edited.)
+        Generation.bump('person')
+        return result
+
+    @staticmethod
+    def _uncache(name):
+        """ Forget cached people, and the course data which has their
+            names, when the 'person' generation has changed. """
+        Person._by_username.clear()
+        Course._snapshots.clear()
     
     def set_password(self, passwordtext):
         with db.atomic():
@@ -275,9 +382,16 @@ class Person(BaseModel):
     @staticmethod
     def admins():
         """ Return list of administrators """
+        # (Dropping someone from the site course's roster stops
+        # them being an admin ; see Course._changed.)
         if not Person._admins:
             Person._admins = {p.username : True
-                              for p in Person.by_rolename('admin')}
+                              for p in Person.select()
+                                             .join(Registration)
+                                             .where(Registration.role ==
+                                                        Role.by_name('admin'),
+                                                    Registration.status !=
+                                                        'drop')}
         return Person._admins
     
 class Course(BaseModel):
@@ -297,16 +411,31 @@ class Course(BaseModel):
     start_date = TextField()
 
     _site_course = None  # course for site data
+    _snapshots = {}      # {course_id: roster etc} ; see _snapshot()
+    _paths = None        # trie of course paths ; see by_path()
+    _paths_generation = None
+    _navigations = {}    # {(course_id, url, rank): compiled menu} ; see nav_html()
 
     def prepared(self):        
         """ setup this instance after it's attributes are set """
         # This method is essentially __init__ for these database objects.
-        self._set_users()
-        self.assignments = self._get_assignments()
-        if not self.start_date:
-            self.semester = ''
-        else:
-            self.semester = Time(self.start_date).semester()
+        # The roster and assignments come from a snapshot shared by
+        # all the Course objects for this course ; see _snapshot().
+        snapshot = self._snapshot()
+        self.students = list(snapshot['students'])
+        self.faculty = list(snapshot['faculty'])
+        self.guests = list(snapshot['guests'])
+        self.username_to_role = dict(snapshot['username_to_role'])
+        self.username_to_rolename = dict(snapshot['username_to_rolename'])
+        # Pages modify their assignments (e.g. ass.work), so each
+        # Course object gets its own copies.
+        self.assignments = []
+        for assignment in snapshot['assignments']:
+            assignment = assignment.copy()
+            assignment.course = self
+            self.assignments.append(assignment)
+        self.semester = snapshot['semester']
+        self.snapshot_generation = snapshot['generation']
         # url without request though that info is also in request
         self.url = umber_url + '/' + self.path
         self.abspath = os.path.join(os_courses, self.path)
@@ -324,25 +453,124 @@ class Course(BaseModel):
             self.prepared()
         return self.__getattribute__(key)
         
-    def _set_users(self):
-        """ define self.students, .faculty, .guests, .username_to_role """
+    def _generation_name(self):
+        return 'course-{}'.format(self.course_id)
+
+    def _snapshot(self):
+        """ Return this course's roster, assignments and semester
+            from this process's cache, or from the database if
+            anything has changed since they were cached. """
+        # Changes (enroll, drop, update_assignments, ...) call _changed(),
+        # which bumps the course's Generation, in all processes.
+        generation = Generation.current(self._generation_name())
+        cached = Course._snapshots.get(self.course_id)
+        if cached and cached['generation'] == generation:
+            return cached
+        snapshot = self._get_users()
+        snapshot['assignments'] = tuple(self._get_assignments())
+        if not self.start_date:
+            snapshot['semester'] = ''
+        else:
+            snapshot['semester'] = Time(self.start_date).semester()
+        snapshot['generation'] = generation
+        Course._snapshots[self.course_id] = snapshot
+        return snapshot
+
+    def _changed(self):
+        """ Note that this course's roster or assignments have changed,
+            and refresh this instance's data. """
+        Generation.bump(self._generation_name())
+        if self.name == 'Umber':
+            # The site course's roster is who the admins are ;
+            # see Person.admins().
+            Generation.bump('admins')
+        self.prepared()
+
+    def _get_users(self):
+        """ return {'students', 'faculty', 'guests', 'username_to_role',
+                    'username_to_rolename'} from the database """
         # .students includes tutors;
         # username_to_rolename lists their role as 'tutor'
-        registrations = list(Registration.select()
+        # One query for all of them, not one per person and per role.
+        registrations = list(Registration.select(Registration, Person, Role)
+                                         .join(Person)
+                                         .switch(Registration)
+                                         .join(Role)
                                          .where((Registration.course == self)
                                           &  (Registration.status != 'drop')))
-        self.students = [reg.person for reg in registrations
-                               if reg.role == Role.by_name('student')]
-        self.faculty = [reg.person for reg in registrations
-                               if reg.role == Role.by_name('faculty')]
-        self.guests = [reg.person for reg in registrations
-                               if reg.role == Role.by_name('guest')]
-        self.students.sort(key=lambda s: s.name)
-        self.faculty.sort(key=lambda s: s.name)
-        self.username_to_role = {reg.person.username : reg.role
-                                 for reg in registrations}
-        self.username_to_rolename = {reg.person.username : reg.rolename()
-                                     for reg in registrations}
+        students = [reg.person for reg in registrations
+                          if reg.role == Role.by_name('student')]
+        faculty = [reg.person for reg in registrations
+                          if reg.role == Role.by_name('faculty')]
+        guests = [reg.person for reg in registrations
+                          if reg.role == Role.by_name('guest')]
+        students.sort(key=lambda s: s.name)
+        faculty.sort(key=lambda s: s.name)
+        # (person, role name, role name or 'tutor') ; see get_registered()
+        registered = [(reg.person, reg.role.name, reg.rolename())
+                      for reg in registrations]
+        registered.sort(key=lambda r: r[0].get_last_first())
+        return {'students': tuple(students),
+                'faculty': tuple(faculty),
+                'guests': tuple(guests),
+                'registered': tuple(registered),
+                'username_to_role': {reg.person.username : reg.role
+                                     for reg in registrations},
+                'username_to_rolename': {reg.person.username : reg.rolename()
+                                         for reg in registrations}}
+
+    def save(self, *args, **kwargs):
+        result = super().save(*args, **kwargs)
+        Generation.bump('courses')
+        Generation.bump(self._generation_name())   # e.g. its semester
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super().delete_instance(*args, **kwargs)
+        Generation.bump('courses')
+        return result
+
+    @staticmethod
+    def _load_paths():
+        """ Build the trie of course paths from the database """
+        # e.g. paths 'demo' and 'a/b' give
+        #   {'demo': {None: {...demo fields...}}, 'a': {'b': {None: {...}}}}
+        Course._paths_generation = Generation.current('courses')
+        trie = {}
+        for fields in Course.select().dicts():
+            node = trie
+            for part in fields['path'].split('/'):
+                node = node.setdefault(part, {})
+            node[None] = fields
+        Course._paths = trie
+
+    @staticmethod
+    def by_path(path):
+        """ Return the course whose folder holds a page path, or None.
+            >>> Course.by_path('demo/home').name
+            'Demo Course'
+            >>> print(Course.by_path('nonesuch/home'))
+            None
+        """
+        # The trie is kept in memory and only reloaded when the set of
+        # courses changes, so this doesn't need a database query.
+        # A course folder within another course shouldn't happen,
+        # but if it does the longest (innermost) one is chosen.
+        if Course._paths is None or \
+           Course._paths_generation != Generation.current('courses'):
+            Course._load_paths()
+        node = Course._paths
+        fields = None
+        for part in path.split('/'):
+            node = node.get(part)
+            if node is None:
+                break
+            fields = node.get(None, fields)
+        if fields is None:
+            return None
+        course = Course(__no_default__=1, **fields)
+        course._dirty.clear()
+        return course
 
     @staticmethod
     def get_all():
@@ -385,6 +613,7 @@ class Course(BaseModel):
             shutil.copytree(abscopyfrom, abspath)
             # remove the old copied .git folder
             shutil.rmtree(os.path.join(abspath, '.git'), ignore_errors=True)
+            filestat.forget(abspath)
         gitlocal.init_add_commit(course, user) # initalize its .git folder
         return course
     
@@ -393,6 +622,9 @@ class Course(BaseModel):
         """ return site admin course 'Umber' """
         if not Course._site_course:
             Course._site_course = Course.get(name='Umber')
+        elif Course._site_course.snapshot_generation != \
+             Generation.current(Course._site_course._generation_name()):
+            Course._site_course.prepared()
         return Course._site_course
 
     @staticmethod
@@ -433,7 +665,7 @@ class Course(BaseModel):
         # (Students who are registered may have submitted work.
         # Rather than delete their files and database records,
         # I'm just changing their status to 'drop', and ignoring
-        # those people in _set_users
+        # those people in _get_users
         try:
             person = user
             name = person.name                 # Is this a Person object?
@@ -448,7 +680,7 @@ class Course(BaseModel):
             registration.date = str(Time())
             registration.save()
         # refresh course data
-        self._set_users()
+        self._changed()
         return "OK, dropped {}.".format(name)
 
     def get_profile_url(self):
@@ -469,20 +701,38 @@ class Course(BaseModel):
         return os.path.join(self.url, home_path)
     
     def get_registered(self, rolename=None):
-        registrations = list(Registration.select()
-                                         .where((Registration.course == self)
-                                          &  (Registration.status != 'drop')))
+        """ Return the people in this course, sorted by last name,
+            with a given role or 'tutor' (or everyone if None).
+            The number of sql queries doesn't depend on how many there are.
+            >>> def people_and_queries(course):
+            ...     Course._snapshots.clear()
+            ...     timing.start_request()
+            ...     people = course.get_registered()
+            ...     queries = timing.query_count()
+            ...     timing.finish_request(None)
+            ...     return (len(people), queries)
+            >>> people_and_queries(Course.by_path('demo'))
+            (4, 2)
+            >>> people_and_queries(Course.get_site())
+            (5, 2)
+            >>> with _example_course(students=50, assignments=1) as course:
+            ...     people_and_queries(course)
+            (50, 2)
+            >>> [p.username for p in Course.by_path('demo').get_registered('tutor')]
+            ['tammytutor']
+        """
+        registered = self._snapshot()['registered']
         if rolename == 'tutor':
-            people = [reg.person for reg in registrations if reg.grade == 'tutor']
+            people = [person for (person, role, name) in registered
+                      if name == 'tutor']
         elif not rolename:
-            people = [reg.person for reg in registrations]
+            people = [person for (person, role, name) in registered]
         elif rolename == 'student':
-            people = [reg.person for reg in registrations
-                      if (reg.role.name == rolename and reg.grade != 'tutor')]
+            people = [person for (person, role, name) in registered
+                      if (role == rolename and name != 'tutor')]
         else:
-            people = [reg.person for reg in registrations
-                      if reg.role.name==rolename]
-        people.sort(key=lambda p: p.get_last_first())
+            people = [person for (person, role, name) in registered
+                      if role == rolename]
         return people
 
     def email_everyone_html(self):
@@ -504,15 +754,34 @@ class Course(BaseModel):
             # Hmmm - not sure why this needs .person_id here, but errors without.
             # Maybe something about how the jinja2 template treats variables?
             # Or because the assignment has had its fields modified??
-            ass.work = ass.get_work(student.person_id)
-            (grade, css_grade) = ass.work.get_grade_css(faculty_view=True)
+            ass.work = ass.find_work(student.person_id)
+            ass.work.assignment = ass
+            seen.apply(ass.work)
+            ass.duedate = Time(ass.due).assigndate()
+        grades = Work.grade_css(Work.grade_columns(
+            [ass.work for ass in result]), faculty_view=True)
+        for (ass, (grade, css_grade)) in zip(result, grades):
             ass.work_grade = grade
             ass.work_css_grade = "grade-{}".format(css_grade)
-            ass.duedate = Time(ass.due).assigndate()
         return result
     
     def grade_data_grid(self):
-        """ return faculty's grade grid for templates/grades.html """
+        """ return faculty's grade grid for templates/grades.html ;
+            the number of sql queries doesn't depend on its size.
+            >>> def size_and_queries(course):
+            ...     course.students          # (the roster is read first)
+            ...     timing.start_request()
+            ...     grid = course.grade_data_grid()
+            ...     queries = timing.query_count()
+            ...     timing.finish_request(None)
+            ...     return (len(grid), len(grid[0]['works']), queries)
+            >>> size_and_queries(Course.by_path('demo'))
+            (2, 2, 1)
+            >>> with _example_course(students=20, assignments=10) as course:
+            ...     works = Work.select().count()
+            ...     print(size_and_queries(course), Work.select().count() - works)
+            (20, 10, 1) 0
+        """
         # Returned data is list of dicts, one per student.
         # Each student dict includes list of student works, one per assignment.
         # The grade will be shown as
@@ -541,23 +810,44 @@ class Course(BaseModel):
         #    red-ish   means that the other person should do something
         #              (i.e. a problem)
         #
+        # All of the course's Work comes from one query. A student
+        # who hasn't opened an assignment's work page yet has no Work
+        # row ; that cell is an unsaved Work (with id 'new_<ass>_<person>'
+        # in the form, see Work.edit_grades) which isn't created
+        # in the database until a grade is entered for it.
+        by_cell = {(work.assignment_id, work.person_id): work
+                   for work in Work.in_course(self)}
         result = []
         for stud in self.students:
             # skip grade line for student if they are a tutor
             if self.username_to_rolename[stud.username] == 'tutor': continue
             works = []
             for ass in self.assignments:
-                work = ass.get_work(stud)
-                (grade, css_grade) = work.get_grade_css(faculty_view=True)
-                works.append({'url':        work.get_url(),
-                              'css_grade':  'grade-{}'.format(css_grade),
-                              'grade':      grade,
-                              'id':         work.work_id
-                              })
+                work = by_cell.get((ass.assignment_id, stud.person_id))
+                if work:
+                    work_id = work.work_id
+                else:
+                    work = Work.virtual(ass, stud)
+                    work_id = 'new_{}_{}'.format(ass.assignment_id,
+                                                 stud.person_id)
+                # (ass and stud are already loaded, so use them.)
+                work.assignment = ass
+                seen.apply(work)    # this process's unflushed seen times
+                works.append((work, {'url':  Work.url_of(self, stud, ass),
+                                     'id':   work_id}))
             result.append({'email': stud.email,
                            'name' : stud.name,
                            'works': works
                            })
+        # Then the grades and colors of all the cells at once.
+        cells = [cell for row in result for cell in row['works']]
+        grades = Work.grade_css(Work.grade_columns(
+            [work for (work, cell) in cells]), faculty_view=True)
+        for ((work, cell), (grade, css_grade)) in zip(cells, grades):
+            cell['grade'] = grade
+            cell['css_grade'] = 'grade-{}'.format(css_grade)
+        for row in result:
+            row['works'] = [cell for (work, cell) in row['works']]
         return result
     
     def get_assignment_by_nth(self, nth):
@@ -601,7 +891,7 @@ class Course(BaseModel):
                 #else:
                     #print_debug("   NOT updating cache ")
                 db_assignments[nth].save()
-        self.assignments = self._get_assignments()
+        self._changed()
 
     def get_assignments_with_extras(self):
         """ Return list of assignments in this course with extra info """
@@ -633,10 +923,38 @@ class Course(BaseModel):
         return Page.get_from_path(os.path.join(self.path,
                             'sys', 'navigation.md'), user=user)
     
+    def nav_key(self, user):
+        """ Return (course_id, url, rank, version) that this user's
+            navigation menu depends on, or None if the course
+            doesn't have a sys/navigation.md """
+        navigation = filestat.stat(os.path.join(self.abspath,
+                                                'sys', 'navigation.md'))
+        if navigation is None:
+            return None
+        # (This is the rank that the navigation page's
+        #  _setup_user_permissions gives this user.)
+        if user.is_admin():
+            rank = Role.by_name('admin').rank
+        else:
+            rank = self.person_to_role(user).rank
+        return (self.course_id, self.url, rank,
+                (navigation.st_mtime_ns, navigation.st_size))
+
     def nav_html(self, user, page):
         """ Return html for course's navigation menu 
             for a given user & a given page """
-        return self.nav_page(user).nav_content_as_html(page)
+        # The menu is compiled (see Page.nav_compile) once for each
+        # role rank and kept until sys/navigation.md changes ;
+        # all that's left to do here is to unlink this page.
+        key = self.nav_key(user)
+        if key is None:
+            return self.nav_page(user).nav_content_as_html(page)
+        (version, key) = (key[-1], key[:-1])
+        cached = Course._navigations.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, self.nav_page(user).nav_compile())
+            Course._navigations[key] = cached
+        return Page.nav_unlink(cached[1], page.url)
 
     @staticmethod
     def enroll_site(person, datestring=None, is_admin=False):
@@ -658,7 +976,7 @@ class Course(BaseModel):
                 reg.date = datestring
             reg.status = ''
             reg.save()
-        site_course._set_users()
+        site_course._changed()
 
     def make_student_work_folders(self):
         for person in self.students:
@@ -709,7 +1027,46 @@ class Course(BaseModel):
             work_abspath = os.path.join(student_abspath, 'work')
             Page.new_folder(work_abspath, user=person)
         # refresh students
-        self._set_users()
+        self._changed()
+
+class AccessRule:
+    """ An access spec from an .access.yaml file or a sys template,
+        e.g. {'read':'all', 'write':['faculty', 'bob']} ,
+        compiled for Page._setup_user_permissions.
+        >>> rule = AccessRule({'read': 'students', 'write': ['faculty', 'bob']})
+        >>> (rule.strings['write'], 'bob' in rule.names['write'])
+        ('faculty, bob', True)
+        >>> rule.rank['read'] == Role.by_name('student').rank
+        True
+        >>> rule.access
+        {'read': 'students', 'write': ['faculty', 'bob']}
+        >>> nobody = AccessRule({'write': 'faculty'})  # no 'read'
+        >>> (Person.get_anonymous().username in nobody.names['read'],
+        ...  nobody.rank['read'] > Role.by_name('visitor').rank)
+        (False, True)
+    """
+    def __init__(self, access_dict):
+        self.access = {}    # {'read': 'students', 'write': ['faculty', 'bob']}
+        self.strings = {}   # {'read': 'students', 'write': 'faculty, bob'}
+        self.names = {}     # {'read': frozenset(('students',)), ...}
+        self.rank = {}      # {'read': 2, 'write': 4} least rank allowed
+        for permission in ('read', 'write'):
+            rights = access_dict.get(permission) or ''
+            if type(rights) == type([]):
+                rights = list(map(str, rights))
+                names = rights
+            else:
+                rights = str(rights)
+                names = [rights]
+            self.access[permission] = rights
+            self.strings[permission] = stringify_access(rights)
+            # (not '' : that's the username of anonymous visitors)
+            self.names[permission] = frozenset(name for name in names if name)
+            # 10 is more than anyone has, i.e. only named users
+            self.rank[permission] = min([10] +
+                                        [Role.by_name(name).rank
+                                         for name in names
+                                         if name in Role.name_alias])
 
 class Page(BaseModel):
 
@@ -746,7 +1103,8 @@ class Page(BaseModel):
     # which are only accessible within the 'site' course.
     system_pages = ('assignments', 'navigation', 'error', 'folder',
                     'grades', 'roster', 'user', 'users', 'course',
-                    'courses', 'registration', 'newuser', 'newcourse')
+                    'courses', 'registration', 'newuser', 'newcourse',
+                    'timing')
     editable_system_pages = ('assignments', 'navigation',
                              'grades', 'user', 'course')
         
@@ -762,6 +1120,10 @@ class Page(BaseModel):
                              to_field='course_id')
 
     _mime_types = None
+    _access_files = {}    # {.access.yaml abspath: (stat, AccessRule or None)}
+    _access_folders = {}  # {folder abspath: (request, when, AccessRule)}
+    _sys_access = None    # {'sys/grades.html': access dict, ...}
+    _sys_access_mtimes = {}
 
     @staticmethod
     def new_folder(abspath, accessdict=None, user=None):
@@ -782,6 +1144,7 @@ class Page(BaseModel):
         # as a workaround to force git to include this new folder.
         # (Git pays attention to files, not folders.)
         open(os.path.join(abspath, '.keep'), 'w').close() # unix 'touch'
+        filestat.forget(abspath)
         # Create the new folder object.
         path = os.path.relpath(abspath, os_courses)
         folder = Page.get_from_path(path, user=user)
@@ -793,18 +1156,25 @@ class Page(BaseModel):
     
     @classmethod
     def get_from_path(cls, path, revision=None, action=None, user=None):
-        """ Get or create a Page and set up all its internal data 
+        """ Get a Page and set up all its internal data 
             i.e. course, file info, user permissions, etc """
-        (page, iscreated) = Page.get_or_create(path=path)
+        # Nothing here is read from or written to the Page table :
+        # the rendered html is cached in rendercache.py, not in the table.
+        # (Otherwise every url ever requested, including typos and
+        # each child of a folder listing, would get a row ...
+        # and each GET would need the sqlite write lock.)
+        page = Page(path=path, html='', html_lastmodified='', notes='')
         if user == None:
             user = Person.get_anonymous()
         page.user = user
         page.action = action
         page.revision = revision
-        page._setup_file_properties()           # sets page.is_file etc
+        with timing.stage('file_properties'):
+            page._setup_file_properties()       # sets page.is_file etc
         page.gitpath = os.path.join(os_courses, page.path_with_ext)
         page.login_google_url = url_for('login_google', pagepath=path)
-        page.course = page.get_course()
+        with timing.stage('get_course'):
+            page.course = page.get_course()
         try:
             if page.course.page_error:
                 ### Unexpected (to me anyway) behavior here :
@@ -823,15 +1193,76 @@ class Page(BaseModel):
             pass
         page.relpath = page._get_relpath()
         page._setup_sys()                   # do this before .get_access()
-        page.access = page.get_access()     # gets .access.yaml property.
-        page._setup_user_permissions()      # sets page.can['read'] etc
+        with timing.stage('get_access'):
+            page.access = page.get_access() # gets .access.yaml property.
+        with timing.stage('user_permissions'):
+            page._setup_user_permissions()  # sets page.can['read'] etc
         if revision or action=='history':
-            page._setup_revision_data()     # sets page.history etc
-        page._setup_attachments()           # sets .has_attachments
-        page._setup_work()                  #
+            with timing.stage('revision_data'):
+                page._setup_revision_data() # sets page.history etc
+        with timing.stage('attachments'):
+            page._setup_attachments()       # sets .has_attachments
+        with timing.stage('work'):
+            page._setup_work()              #
         page.html_title = page.get_html_title()
         return page
 
+    def timing_kind(self):
+        """ Return kind of umber page for timing.py :
+            'sys', 'work', 'folder', or 'markdown' """
+        if self.is_sys:
+            return 'sys'
+        elif self.is_work:
+            return 'work'
+        elif self.is_dir:
+            return 'folder'
+        else:
+            return 'markdown'
+
+    def validator(self):
+        """ Return a string which changes whenever this markdown page's
+            html for this user may change, for an http ETag ;
+            or None if its html shouldn't be cached by the browser. """
+        # That html depends on the file, the course's navigation menu and
+        # data (name, semester ; see Course._snapshot), the attachments,
+        # and what this user is allowed to see and do. Also the date,
+        # so that anything else is at most a day stale.
+        if not (self.is_file and self.ext == '.md') or self.is_sys or \
+           self.is_work or self.revision or self.action:
+            return None
+        stat = filestat.stat(self.abspath)
+        navigation = filestat.stat(os.path.join(self.course.abspath,
+                                                'sys', 'navigation.md'))
+        parts = [self.path, str(stat.st_mtime_ns), str(stat.st_size),
+                 str(navigation and navigation.st_mtime_ns),
+                 str(self.course.course_id),
+                 str(self.course.snapshot_generation),
+                 self.user.username, self.user_role.name, self.user_rolename,
+                 str(self.can), self.read_access, self.write_access,
+                 str(Time())[:10]]
+        for attachment in self.attachments:
+            parts += [attachment.name_with_ext, str(attachment.lastmodified),
+                      str(attachment.size)]
+        return md5('|'.join(parts))
+    
+    @staticmethod
+    def prune_orphans():
+        """ Delete Page rows that aren't referenced by any Work.
+            Return the number of rows deleted. """
+        # See bin/umber_prune_pages. (Older versions of umber created
+        # a row for every url and cached the html of markdown pages
+        # in it ; that's now in rendercache.py.)
+        used = Work.select(Work.page)
+        orphans = [page_id for (page_id,) in
+                   Page.select(Page.page_id)
+                       .where(Page.page_id.not_in(used)).tuples()]
+        chunk = 500   # sqlite has a limit on the number of sql variables
+        with db.atomic():
+            for i in range(0, len(orphans), chunk):
+                Page.delete().where(
+                    Page.page_id.in_(orphans[i:i+chunk])).execute()
+        return len(orphans)
+
     def get_html_title(self):
         """ Return string for the <title></title> html tag. """
         try:
@@ -859,7 +1290,7 @@ class Page(BaseModel):
     def _setup_attachments(self):
         if self.is_file and self.ext == '.md':
             attach_dir = self.attachments_folder()
-            if os.path.exists(attach_dir) and os.path.isdir(attach_dir):
+            if filestat.isdir(attach_dir):
                 self.attachments = self.children(abspath=attach_dir)
             else:
                 self.attachments = []
@@ -882,7 +1313,8 @@ class Page(BaseModel):
             work_nth = int(work_nth)
             self.work_person = Person.by_username(work_username)
             self.work_assignment = self.course.get_assignment_by_nth(work_nth)
-            self.work = self.work_assignment.get_work(self.work_person)
+            self.work = self.work_assignment.find_work(self.work_person)
+            seen.apply(self.work)
             duedate = Time(self.work_assignment.due)
             self.work_due = duedate.assigndatedetail()
             # ... but give students a extra grace period of a few hours
@@ -898,15 +1330,11 @@ class Page(BaseModel):
                 self.work_submitted = ''
                 self.work_is_late = now > duedate
             self.work_grade = self.work.grade
-            # update *_seen fields in the database
-            # TODO : think about whether there's a better
-            #        transactional way to update the database here.
+            # update *_seen fields in the database ... soon ; see seen.py
             if self.user_role.name == 'faculty':
-                self.work.faculty_seen = str(now)
-                self.work.save()
+                seen.mark(self.work, 'faculty_seen', str(now))
             if self.user.username == work_username:
-                self.work.student_seen = str(now)
-                self.work.save()
+                seen.mark(self.work, 'student_seen', str(now))
         else:
             self.is_work = False
             #self.work = None
@@ -942,28 +1370,9 @@ class Page(BaseModel):
         """ return this page's course """
         # And if there is no course for this page,
         # return the site course but also set an error within it.
-        #
-        # extract path pieces e.g. ['demo', 'home']
-        path_parts = self.path.split('/')
-        # build partial paths e.g. ['demo', 'demo/home']
-        # (stackoverflow.com/questions/13221896/python-partial-sum-of-numbers)
-        paths = reduce(lambda x,y: x + [x[-1]+'/'+y],
-                       path_parts[1:], path_parts[0:1])
-        # build peewee's "where condition" to find matching courses.
-        condition = Course.path
-        for c in paths:
-            condition = condition | Course.path % c
-        # Get list of matching courses from database.
-        # Choose the one with the longest path,
-        # if more than on was found ...
-        # which would only happen for courses directories
-        # embedded within another course, which shouldn't happen.
-        # TODO: make sure to test for that issue during new course creation
-        query = Course.select().where(condition)
-        courses = list(query.execute())
-        #
-        if courses:
-            return max(courses, key=lambda c: len(c.path))
+        course = Course.by_path(self.path)
+        if course:
+            return course
         else:
             # Couldn't find a course for that page, so return
             # the default course with a flag indicating the error.
@@ -982,6 +1391,9 @@ class Page(BaseModel):
         # (yaml.dump turns u'string' into ugly stuff so I convert to str().
         accessfile.write(yaml.dump(clean_access_dict(accessdict)))
         accessfile.close()
+        filestat.forget(accesspath)
+        Page._access_files.pop(accesspath, None)
+        Page._access_folders.clear()    # its subfolders' rules may change too
         if do_git:
             # I've left an option to avoid this to handle
             # the case of a new folder efficiently, since
@@ -1007,37 +1419,99 @@ class Page(BaseModel):
             else:
                 ## all other system files have an access spec as their first line
                 ## e.g.  {# {'read':'all', 'write':'faculty' #}
-                template = os.path.join(os_root, 'templates', self.sys_template)
-                firstline = open(template).readline()
+                access_dict = Page.sys_access_table()[self.sys_template]
+            rule = AccessRule(access_dict)
+        else:
+            if self.is_dir:
+                folder = self.abspath
+            else:
+                folder = os.path.dirname(self.abspath)
+            # If there isn't any .access.yaml, nobody but faculty can see it.
+            rule = Page._folder_access(folder.rstrip('/')) or AccessRule({})
+        self.access_rule = rule
+        # clean up for display :
+        self.read_access = rule.strings['read']
+        self.write_access = rule.strings['write']
+        return dict(rule.access)
+
+    @staticmethod
+    def sys_access_table():
+        """ Return a read-only {template: access dict} for the sys templates,
+            from their first lines e.g.  {# {'read':'all', 'write':'faculty'} #}
+            >>> Page.sys_access_table()['sys/grades.html']['read']
+            'member'
+            >>> Page.sys_access_table()['sys/error.html']['read']
+            'faculty'
+        """
+        # These are read once ; in development they're read again
+        # whenever a template is added or edited.
+        if Page._sys_access is None or \
+           (umber_debug and Page._sys_access_mtimes != Page._sys_mtimes()):
+            Page._sys_access_mtimes = Page._sys_mtimes()
+            table = {}
+            for name in Page._sys_access_mtimes:
+                template = os.path.join(os_root, 'templates', name)
+                with open(template) as templatefile:
+                    firstline = templatefile.readline()
                 try:
-                    access_dict = eval(firstline.replace('{#','').replace('#}',''))
+                    access_dict = ast.literal_eval(
+                        firstline.replace('{#','').replace('#}','').strip())
+                    assert type(access_dict) == type({})
                 except:
                     # something fairly safe as a fall-back
                     access_dict = {'read':'faculty', 'write':'faculty'}
+                table[name] = MappingProxyType(access_dict)
+            Page._sys_access = MappingProxyType(table)
+        return Page._sys_access
+
+    @staticmethod
+    def _sys_mtimes():
+        """ Return {'sys/grades.html': modification time, ...} """
+        folder = os.path.join(os_root, 'templates', 'sys')
+        return {'sys/' + entry.name : entry.stat().st_mtime_ns
+                for entry in os.scandir(folder)
+                if entry.name.endswith('.html')}
+
+    @staticmethod
+    def _access_file(accesspath):
+        """ Return the AccessRule from an .access.yaml file, or None
+            if there isn't one. Each file is only read when it changes. """
+        stat = filestat.stat(accesspath)
+        if stat is None:
+            return None
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = Page._access_files.get(accesspath)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(accesspath) as accessfile:
+            # see https://msg.pyyaml.org/load
+            access_dict = yaml.full_load(accessfile)
+        if type(access_dict) == type({}):
+            rule = AccessRule(access_dict)
         else:
-            if self.is_dir:
-                abspath = self.abspath
-            else:
-                abspath = os.path.dirname(self.abspath)
-            while len(abspath) >= len(os_courses):
-                accesspath = os.path.join(abspath, '.access.yaml')
-                if os.path.exists(accesspath):
-                    accessfile = open(accesspath)
-                    # see https://msg.pyyaml.org/load
-                    access_dict = yaml.full_load(accessfile)
-                    accessfile.close()
-                    if type(access_dict) == type({}):
-                        # OK, we found an access dict, so stop here.
-                        break
-                abspath = os.path.dirname(abspath) # i.e. "cd .."
-        if 'read' not in access_dict:
-            access_dict['read'] = ''
-        if 'write' not in access_dict:
-            access_dict['write'] = ''
-        # clean up for display :
-        self.read_access = stringify_access(access_dict['read'])
-        self.write_access = stringify_access(access_dict['write'])
-        return access_dict
+            rule = None
+        filestat.remember(Page._access_files, accesspath, (key, rule))
+        return rule
+
+    @staticmethod
+    def _folder_access(folder):
+        """ Return the AccessRule for pages in a folder, from the
+            .access.yaml in it or in the closest enclosing folder. """
+        # Remembered for the rest of this request (and a few seconds
+        # outside of requests) since each child in a folder listing
+        # and each parent folder asks for the same thing.
+        memo = Page._access_folders.get(folder)
+        if memo and memo[0] == filestat.request_number() and \
+           time() - memo[1] < file_stat_seconds:
+            return memo[2]
+        if len(folder) < len(os_courses):
+            return None
+        rule = Page._access_file(os.path.join(folder, '.access.yaml'))
+        if rule is None and os.path.dirname(folder) != folder:
+            rule = Page._folder_access(os.path.dirname(folder)) # i.e. "cd .."
+        filestat.remember(Page._access_folders, folder,
+                          (filestat.request_number(), time(), rule))
+        return rule
 
     def _setup_user_permissions(self):
         """ Set page.can['read'], page.can['write'],
@@ -1074,20 +1548,11 @@ class Page(BaseModel):
                 self.user_role = Role.by_name('admin')
     
         self.can = {'read':False, 'write':False} # default is deny access
+        rule = self.access_rule
         for permission in ('read', 'write'):
-            yaml_rights = self.access[permission]
-            access_needed = 10  # i.e. more than anyone has by default
-            # can be list e.g. ['faculty', 'bob'] or string 'students'
-            if type(yaml_rights) == type(''):
-                yaml_rights = [ yaml_rights ]
-            for name_or_role in yaml_rights:
-                if name_or_role == self.user.username:
-                    self.can[permission] = True
-                    break
-                elif name_or_role in Role.name_alias:
-                    access_needed = min(access_needed, \
-                                        Role.by_name(name_or_role).rank)
-            if self.user_rank >= access_needed:
+            # allowed by username e.g. 'bob' or by role e.g. 'students'
+            if self.user.username in rule.names[permission] or \
+               self.user_rank >= rule.rank[permission]:
                 self.can[permission] = True
 
     def get_mimetype(self):
@@ -1108,7 +1573,7 @@ class Page(BaseModel):
             abspath = self.abspath
         try:
             path = os.path.relpath(abspath, os_courses)
-            for name in sorted(os.listdir(abspath)):
+            for name in filestat.listdir(abspath):
                 if name[0] == '.':  # skip invisible files e.g. .access.yaml
                     continue
                 result.append(Page.get_from_path(os.path.join(path, name), user=self.user))
@@ -1168,15 +1633,18 @@ class Page(BaseModel):
             including self.absfilename, self.exists, self.is_file, self.is_dir,
             self.lastmodified, self.breadcrumbs
          """
+        # The os.stat data comes from filestat's cache,
+        # with one stat per path rather than exists, isfile, ... calls.
         self.abspath = os.path.join(os_courses, self.path)
         self.path_with_ext = self.path  # default, unless modified below
-        if not os.path.exists(self.abspath):
-            for ext in ['.md', '.html']:
-                if ext == '.md' and os.path.exists(self.abspath + ext):
-                    self.abspath = self.abspath + ext
-                    self.path_with_ext = self.path + ext
+        stat = filestat.stat(self.abspath)
+        if not stat:
+            stat = filestat.stat(self.abspath + '.md')
+            if stat:
+                self.abspath = self.abspath + '.md'
+                self.path_with_ext = self.path + '.md'
         (ignore, self.ext) = os.path.splitext(self.abspath)
-        self.exists = os.path.exists(self.abspath)
+        self.exists = stat is not None
         #print_debug(f'debug _setup_file_properties : path={self.path} exists={self.exists} ')
         if not self.exists and self.ext == '':
             # creating a new file, so make it a .md markdown file
@@ -1189,10 +1657,9 @@ class Page(BaseModel):
             self.name = self.name_with_ext[: - len(self.ext) ]
         # self.name_underlined = self.name + '\n' + '='*len(self.name)
         self.path_no_name = self.path[: - len(self.name) ]
-        self.is_file = os.path.isfile(self.abspath)
-        self.is_dir = os.path.isdir(self.abspath)
+        self.is_file = self.exists and S_ISREG(stat.st_mode)
+        self.is_dir = self.exists and S_ISDIR(stat.st_mode)
         if self.exists:
-            stat = os.stat(self.abspath)
             #print_debug(f'debug _setup_file_properties : stat={str(stat)}')
             self.lastmodified = Time(stat.st_mtime)
             if self.is_dir:
@@ -1222,9 +1689,18 @@ class Page(BaseModel):
         self.bytesize = size_in_bytes(self.size)
 
     def revision_content_as_html(self):
-        content = gitlocal.get_revision(self)
-        content_with_links = link_translate(self.course, content)
-        return markdown2html(content_with_links)
+        """ Return html for a git revision of a markdown page """
+        # A commit never changes, so its html can be kept indefinitely.
+        key = rendercache.key('revision', ' '.join((self.revision_commit,
+                                                    self.get_gitpath(),
+                                                    self.course.url)))
+        html = rendercache.get(key)
+        if html is None:
+            content = gitlocal.get_revision(self)
+            content_with_links = link_translate(self.course, content)
+            html = markdown2html(content_with_links)
+            rendercache.put(key, html)
+        return html
 
     def content(self):
         """ Return file or github (revision) data for a page """
@@ -1256,6 +1732,7 @@ class Page(BaseModel):
                 except:
                     new_bytes = new_content
                 bytes_written = _file.write(new_bytes)
+            filestat.forget(self.abspath)
         return bytes_written
 
     def content_as_html(self):
@@ -1264,35 +1741,39 @@ class Page(BaseModel):
         if not self.exists:
             return ''
         elif self.ext == '.md':
-            # I'm caching the html version of .md pages in the sql database
-            # (for the current version)
-            # checking to see if the cache is stale with
-            # the file's lastmodified and a sql db html_lastmodified fields.
-            #print_debug(f" debug content_as_html cache")
-            #print_debug(f"   lastmodified='{self.lastmodified}' ; " + \
-            #            f"html_lastmodified='{self.html_lastmodified}'")
+            # The html is cached by rendercache.py ; for the current
+            # version, keyed by what markdown2html is given.
             if self.revision:
-                content = self.content()  # pull from git repo
+                html = self.revision_content_as_html()
+            else:
+                content = self.content()  # pull from file
                 content_with_links = link_translate(self.course, content)
-                self.html = markdown2html(content_with_links)
-                self.html_lastmodified = str(self.lastmodified)
-            elif str(self.lastmodified) != self.html_lastmodified:
-                 #print_debug(f"   updating {self.path}")
-                with db.atomic():
-                    content = self.content()  # pull from file
-                    content_with_links = link_translate(self.course, content)
-                    self.html = markdown2html(content_with_links)
-                    self.html_lastmodified = str(self.lastmodified)
-                    self.save()
-            #else:
-                #print_debug(f"   using cache {self.path}")
-                # cache : just use .html already read from sql
-            html = self.html
+                key = rendercache.key('markdown', content_with_links)
+                html = rendercache.get(key)
+                if html is None:
+                    html = markdown2html(content_with_links)
+                    rendercache.put(key, html)
         else:
             # Not markdown, so send the file (txt, html, ...) as is.
             html = self.content() # from file or git repo
         return html
 
+    def highlighted_html(self):
+        """ Return a syntax highlighted html webpage for this code file
+            (i.e. for page.py?html) """
+        # Cached by rendercache.py, keyed by file path, mtime & lexer.
+        stat = None if self.revision else filestat.stat(self.abspath)
+        if not stat:
+            return pygmentize(self.content(), filename=self.name_with_ext)
+        key = rendercache.key('pygments', ' '.join((self.abspath,
+            str(stat.st_mtime_ns), str(stat.st_size),
+            str(lexer_name(self.name_with_ext)))))
+        html = rendercache.get(key)
+        if html is None:
+            html = pygmentize(self.content(), filename=self.name_with_ext)
+            rendercache.put(key, html)
+        return html
+
     def action_query(self):
         """ Return empty string or '&action=edit' if editing """
         if self.action == 'edit':
@@ -1303,7 +1784,14 @@ class Page(BaseModel):
     def nav_content_as_html(self, page):
         """ Return authorized parts of html & markdown at html . """
         # Here self is the navigation.md page.
-        #   TODO: unlinkify current page
+        return Page.nav_unlink(self.nav_compile(), page.url)
+
+    def nav_compile(self):
+        """ Return (html, anchors) for this navigation.md page, where
+            anchors is {url: (start, end, span)} : the first link to
+            each url is html[start:end], and span is its unlinked html. """
+        # Here self is the navigation.md page ; the result depends only
+        # on its file, its course and self.user_rank. See nav_unlink.
         #   TODO: This implementation is pretty ugly.
         #         Perhaps just do this explicitly without BeautifulSoup?
         #         And make some tests ...
@@ -1338,27 +1826,62 @@ class Page(BaseModel):
             inside = insides.pop(0)
             html = html.replace(marker, inside, 1)
         # If the current page is one of the links in the nav menu,
-        # that link should be unlinkified ... which I'm doing
-        # with another (ugh) pass through BeautifulSoup,
-        # now that markdown has run.
+        # that link should be unlinkified ... which takes
+        # another (ugh) pass through BeautifulSoup, now that markdown
+        # has run. So here, the first link to each url is swapped for
+        # a marker, to find where it is in the html and what its
+        # replacement <span class="thispage"> is for nav_unlink.
         # -------------
         # TODO do the right thing for file.md, file.html,
         # and folder ; currently only "file" and "folder/" will work
         # in the nav markdown; the other non-canonical with redirectrs won't.
         # (So check other options in a loop, eh?)
         parser = BeautifulSoup(html, 'html.parser')
-        anchor = parser.find('a', href=page.url)
-        if anchor:
+        anchors = {}
+        links = []      # [(url, anchor html, span html)]
+        for anchor in parser.find_all('a', href=True):
+            if anchor['href'] in anchors:
+                continue
+            anchors[anchor['href']] = None
             span = parser.new_tag('span')
             span['class'] = 'thispage'
             span.string = anchor.string
-            parser.find('a', href=page.url).replace_with(span)
-        html = str(parser)
-        return html
+            links.append((anchor['href'], str(anchor), str(span)))
+            anchor.replace_with('\0{}\0'.format(len(links) - 1))
+        pieces = str(parser).split('\0')
+        # pieces alternate : html, link index, html, link index, ... html
+        html = ''
+        for (i, piece) in enumerate(pieces):
+            if i % 2:
+                (url, anchor_html, span_html) = links[int(piece)]
+                anchors[url] = (len(html), len(html) + len(anchor_html),
+                                span_html)
+                html += anchor_html
+            else:
+                html += piece
+        return (html, anchors)
+
+    @staticmethod
+    def nav_unlink(compiled, url):
+        """ Return the html of a compiled navigation menu (see nav_compile)
+            with its link to this url, if any, made into a span.
+            >>> menu = ('<p><a href="/a">A</a></p>',
+            ...         {'/a': (3, 21, '<span class="thispage">A</span>')})
+            >>> Page.nav_unlink(menu, '/a')
+            '<p><span class="thispage">A</span></p>'
+            >>> Page.nav_unlink(menu, '/b')
+            '<p><a href="/a">A</a></p>'
+        """
+        (html, anchors) = compiled
+        if url not in anchors:
+            return html
+        (start, end, span) = anchors[url]
+        return html[:start] + span + html[end:]
     
 class Assignment(BaseModel):
     class Meta:
         db_table = 'Assignment'
+        indexes = ((('course', 'due_epoch'), False),)
 
     assignment_id = PrimaryKeyField(db_column='assignment_id')
     
@@ -1370,6 +1893,9 @@ class Assignment(BaseModel):
     due = TextField(null=True)
     name = TextField()
     notes = TextField()
+    due_epoch = IntegerField(default=0)
+
+    _epoch_fields = {'due': 'due_epoch'}
     
     course = ForeignKeyField(model=Course,
                              db_column='course_id',
@@ -1382,23 +1908,24 @@ class Assignment(BaseModel):
         """ return html version of assignment name with <br> instead of spaces """
         return self.name.replace(' ', '<br>')
 
+    def find_work(self, person):
+        """ Return Work for this assignment by given student,
+            or an unsaved blank one ; see Work.virtual """
+        # (Unlike get_work, this doesn't write to the database.)
+        work = (Work.select()
+                    .where(Work.assignment == self, Work.person == person)
+                    .first())
+        return work or Work.virtual(self, person)
+
     def get_work(self, person):
-        """ Return Work for this assignment by given student """
+        """ Return Work for this assignment by given student,
+            creating it if need be """
         # i.e. work = assignment.get_work(student)
-        with db.atomic():
-            (work, created) = Work.get_or_create(assignment = self,
-                                                 person = person)
-            if created:
-                work.grade = ''     # | I would have expected this to be 
-                work.notes = ''     # | created with the sql defaults ...
-                work.submitted = '' # | but apparently not.
-                work.student_modified = ''
-                work.faculty_modified = ''
-                work.student_seen     = ''
-                work.faculty_seen     = ''
-                work.page = 0
-                work.save()
-        return work
+        with db.atomic('IMMEDIATE'):
+            Work.insert_new([Work.virtual(self, person).__data__])
+            return (Work.select()
+                        .where(Work.assignment == self, Work.person == person)
+                        .get())
     
 class Role(BaseModel):
     class Meta:
@@ -1453,6 +1980,12 @@ class Role(BaseModel):
         with db.atomic():
             for (name, rank) in list(Role.name_rank.items()):
                 Role.get_or_create(name=name, rank=rank)
+            Generation.bump('roles')
+
+    @staticmethod
+    def _uncache(name):
+        """ Forget cached roles ; see Generation.watch """
+        Role._cache.clear()
                 
 class Registration(BaseModel):
     class Meta:
@@ -1483,6 +2016,7 @@ class Registration(BaseModel):
 class Work(BaseModel):
     class Meta:
         db_table = 'Work'
+        indexes = ((('assignment', 'submitted_epoch'), False),)
 
     work_id = PrimaryKeyField(db_column='work_id')
                 
@@ -1493,100 +2027,345 @@ class Work(BaseModel):
     student_seen = TextField(db_column='student_seen')
     faculty_modified = TextField(db_column='faculty_modified')
     faculty_seen = TextField(db_column='faculty_seen')
+    submitted_epoch = IntegerField(default=0)
+    student_modified_epoch = IntegerField(default=0)
+    student_seen_epoch = IntegerField(default=0)
+    faculty_modified_epoch = IntegerField(default=0)
+    faculty_seen_epoch = IntegerField(default=0)
+
+    # Most ids in one "IN (...)" ; see edit_grades. (Older sqlite
+    # versions allow at most 999 variables in one sql statement.)
+    _sql_chunk = 400
+
+    _epoch_fields = {'submitted': 'submitted_epoch',
+                     'student_modified': 'student_modified_epoch',
+                     'student_seen': 'student_seen_epoch',
+                     'faculty_modified': 'faculty_modified_epoch',
+                     'faculty_seen': 'faculty_seen_epoch'}
 
     assignment = ForeignKeyField(model=Assignment,
                                  db_column='assignment_id',
                                  to_field='assignment_id')
     person = ForeignKeyField(model=Person,
                              db_column='person_id',
-                             to_field='person_id')
+                             to_field='person_id',
+                             index=True)
     page = ForeignKeyField(model=Page,
                            db_column='page_id',
                            to_field='page_id')
 
+    # These queries compare the *_epoch columns in sql,
+    # rather than making a Time for each field of each row.
+    # The due date includes settings.due_grace_hours, as in get_grade_css.
+
+    @staticmethod
+    def in_course(course):
+        """ Return a query of the Work in a course, with its Assignment """
+        return (Work.select(Work, Assignment)
+                    .join(Assignment)
+                    .where(Assignment.course == course))
+
+    @staticmethod
+    def overdue(course, now=None):
+        """ Return a query of the unsubmitted Work in a course
+            which is past due """
+        now = epoch_of(now) if now else int(Time().epoch)
+        return (Work.in_course(course)
+                    .where(Work.submitted_epoch == 0,
+                           Assignment.due_epoch > 0,
+                           Assignment.due_epoch + 3600 * due_grace_hours
+                             <= now))
+
+    @staticmethod
+    def submitted_late(course):
+        """ Return a query of the Work in a course
+            which was submitted after it was due """
+        return (Work.in_course(course)
+                    .where(Work.submitted_epoch > 0,
+                           Assignment.due_epoch > 0,
+                           Work.submitted_epoch >
+                             Assignment.due_epoch + 3600 * due_grace_hours))
+
+    @staticmethod
+    def modified_since_seen(course, faculty_view):
+        """ Return a query of the Work in a course which one side
+            (the students if faculty_view, else the faculty) has changed
+            since the other side last looked at it.
+            >>> democourse = Course.get(Course.name == 'Demo Course')
+            >>> [work.person.username for work
+            ...  in Work.modified_since_seen(democourse, faculty_view=False)]
+            ['johnsmith']
+        """
+        if faculty_view:
+            changed = Work.student_modified_epoch > Work.faculty_seen_epoch
+        else:
+            changed = Work.faculty_modified_epoch > Work.student_seen_epoch
+        return Work.in_course(course).where(changed)
+
+    @staticmethod
+    def virtual(assignment, person):
+        """ Return an unsaved blank Work, as get_work would create """
+        return Work(assignment=assignment, person=person, page=0,
+                    grade='', notes='', submitted='',
+                    student_modified='', faculty_modified='',
+                    student_seen='', faculty_seen='')
+
+    @staticmethod
+    def url_of(course, person, assignment):
+        """ Return the url of a student's work page for an assignment """
+        # Also see templates/assignments.html
+        return '{}/students/{}/work/{}.md'.format(course.url,
+                                                  person.username,
+                                                  assignment.nth)
+
     @staticmethod
     def edit_grades(id_grade_dict):
         """ id_grade_dict is web form with some {'work_<id>':new_grade}
-            extract id's & change grades """
+            extract id's & change grades. Return {key: result} for each
+            work_ key, where result is one of 'changed', 'unchanged',
+            'created', 'blank' (a new cell left empty), 'missing'
+            (no such work), 'invalid' (a malformed key) or 'failed'.
+            >>> work = Work.select().where(Work.grade == 'B').get()
+            >>> results = Work.edit_grades({'work_{}'.format(work.work_id): 'B',
+            ...     'work_0': 'A', 'work_x': 'A', 'submit_grades': '1'})
+            >>> sorted(results.values())
+            ['invalid', 'missing', 'unchanged']
+            >>> with _example_course(students=40, assignments=10,
+            ...                      works=True) as course:
+            ...     works = list(Work.in_course(course))
+            ...     results = Work.edit_grades({'work_{}'.format(work.work_id): 'A'
+            ...                                 for work in works})
+            ...     grades = {work.grade for work in Work.in_course(course)}
+            ...     print(len(works), set(results.values()), grades)
+            400 {'changed'} {'A'}
+        """
         # the dict also has other keys i.e. 'submit_work'; ignore them.
+        # A 'work_new_<assignment_id>_<person_id>' key is a grid cell
+        # with no Work yet ; see Course.grade_data_grid.
+        # The works are read with one query, and only the grades which
+        # changed are written, with one prepared update and one insert,
+        # so that saving a big grid holds the sqlite write lock briefly.
+        results = {}
+        grades = {}       # {work_id: (key, grade)}
+        new_cells = {}    # {(assignment_id, person_id): (key, grade)}
+        for key in id_grade_dict:
+            if key[:5] != 'work_':
+                continue
+            # See get_grade_css for special grades ..., 
+            # The special grades "...", "overdue', 'ungraded'
+            # are created when the actual grade is not set yet.
+            grade = id_grade_dict[key]
+            if grade in ('…', '...', 'overdue', 'ungraded'):
+                grade = ''
+            try:
+                if key[5:9] == 'new_':
+                    (assignment_id, person_id) = key[9:].split('_')
+                    if grade:
+                        new_cells[(int(assignment_id), int(person_id))] = \
+                            (key, grade)
+                    else:
+                        results[key] = 'blank'
+                else:
+                    grades[int(key[5:])] = (key, grade)
+            except ValueError:
+                results[key] = 'invalid'
         try:
-            with db.atomic():
-                for key in id_grade_dict:
-                    if key[:5] == 'work_':  
-                        id = int(key[5:])
-                        work = Work.get(work_id=id)
-                        # See get_grade_css for special grades ..., 
-                        # The special grades "...", "overdue', 'ungraded'
-                        # are created when the actual grade is not set yet.
-                        grade = id_grade_dict[key]
-                        if grade in ('…', '...', 'overdue', 'ungraded'):
-                            grade = ''
-                        work.grade = grade
-                        work.save()
-        except:
-            print_debug('OOPS : Work.edit_grades(id_grade_dict="{}") failed' \
-                                .format(id_grade_dict))
+            with db.atomic('IMMEDIATE'):
+                (changed, created) = Work._diff_grades(grades, new_cells,
+                                                       results)
+                db.cursor().executemany(
+                    'UPDATE Work SET grade = ? WHERE work_id = ?',
+                    [(grade, work_id) for (work_id, grade) in changed.items()])
+                Work.insert_new(created)
+        except DatabaseError as error:
+            print_debug('OOPS : Work.edit_grades(id_grade_dict="{}") failed : {}' \
+                                .format(id_grade_dict, error))
+            for key in results:
+                if results[key] in ('changed', 'created'):
+                    results[key] = 'failed'
+        return results
+
+    @staticmethod
+    def _diff_grades(grades, new_cells, results):
+        """ Return ({work_id: grade} to update, [row, ...] to insert)
+            for edit_grades, and put each cell's result in results """
+        # New cells which do have a Work (made since the form was sent)
+        # are updated like the others.
+        if new_cells:
+            for (cell, work_id) in Work.ids_of(list(new_cells)).items():
+                grades[work_id] = new_cells.pop(cell)
+            assignment_ids = list({a for (a, p) in new_cells})
+            known = set()
+            for ids in chunked(assignment_ids, Work._sql_chunk):
+                known.update(assignment_id for (assignment_id,) in
+                             Assignment.select(Assignment.assignment_id)
+                               .where(Assignment.assignment_id.in_(ids))
+                               .tuples())
+        current = {}      # {work_id: grade} as in the database
+        for ids in chunked(list(grades), Work._sql_chunk):
+            current.update(Work.select(Work.work_id, Work.grade)
+                               .where(Work.work_id.in_(ids))
+                               .tuples())
+        changed = {}
+        for (work_id, (key, grade)) in grades.items():
+            if work_id not in current:
+                results[key] = 'missing'
+            elif current[work_id] == grade:
+                results[key] = 'unchanged'
+            else:
+                changed[work_id] = grade
+                results[key] = 'changed'
+        created = []
+        for ((assignment_id, person_id), (key, grade)) in new_cells.items():
+            if assignment_id in known:
+                work = Work.virtual(assignment_id, person_id)
+                work.grade = grade
+                created.append(dict(work.__data__))
+                results[key] = 'created'
+            else:
+                results[key] = 'missing'
+        return (changed, created)
     
+    @staticmethod
+    def ids_of(cells):
+        """ Return {(assignment_id, person_id): work_id} for the cells
+            in a list of (assignment_id, person_id) which have a Work """
+        ids = {}
+        for chunk in chunked(cells, Work._sql_chunk // 2):
+            wanted = set(chunk)
+            for (work_id, assignment_id, person_id) in (
+                    Work.select(Work.work_id, Work.assignment, Work.person)
+                        .where(Work.assignment.in_({a for (a, p) in chunk}),
+                               Work.person.in_({p for (a, p) in chunk}))
+                        .tuples()):
+                if (assignment_id, person_id) in wanted:
+                    ids[(assignment_id, person_id)] = work_id
+        return ids
+
+    @staticmethod
+    def insert_new(rows):
+        """ Insert Work rows (dicts, e.g. from Work.virtual(...).__data__),
+            skipping any whose (assignment, person) already has a Work """
+        # The unique index work_assignment_person (see database/umber.sql)
+        # means that a Work made by another process (or the seen.py flush)
+        # in the meantime isn't duplicated.
+        for chunk in chunked(rows, Work._sql_chunk // 20):
+            Work.insert_many(chunk).on_conflict_ignore().execute()
+
     def get_url(self):
-        # Also see templates/assignments.html
-        return '{}/students/{}/work/{}.md'.format(self.assignment.course.url,
-                                                  self.person.username,
-                                                  self.assignment.nth)
+        return Work.url_of(self.assignment.course, self.person, self.assignment)
 
     def get_grade_css(self, faculty_view):
-        css_class = 'black'      # the default
-        #
-        duedate = Time(self.assignment.due)
-        duedate.arrow = duedate.arrow.shift(hours=due_grace_hours)
-        now = Time()
-        before_due_date = now < duedate
-        #
-        # Set blank times to '1901' to avoid errors.
-        faculty_modified = self.faculty_modified or '1901'
-        faculty_seen = self.faculty_seen or '1901'
-        student_modified = self.student_modified or '1901'
-        student_seen = self.student_seen or '1901'
-        #print_debug("   faculty_modified = '{}'".format(faculty_modified))
-        #print_debug("   faculty_seen = '{}'".format(faculty_seen))
-        #print_debug("   student_modified = '{}'".format(student_modified))
-        #print_debug("   student_seen = '{}'".format(student_seen))
+        """ Return (grade, css_class) for this work ; see grade_css """
+        # (From the time strings, which may not have been saved yet.)
+        columns = {field: [epoch_of(getattr(self, field))]
+                   for field in Work._epoch_fields}
+        columns['due'] = [epoch_of(self.assignment.due)]
+        columns['grade'] = [self.grade]
+        return Work.grade_css(columns, faculty_view)[0]
+
+    @staticmethod
+    def grade_columns(works):
+        """ Return the columns that grade_css needs for a list of Work,
+            from their saved *_epoch fields and their assignments """
+        columns = {field: [getattr(work, epoch_field) for work in works]
+                   for (field, epoch_field) in Work._epoch_fields.items()}
+        columns['due'] = [work.assignment.due_epoch for work in works]
+        columns['grade'] = [work.grade for work in works]
+        return columns
+
+    @staticmethod
+    def grade_css(columns, faculty_view, now=None):
+        """ Return [(grade, css_class), ...] for many works at once,
+            given columns {'due', 'submitted', 'student_seen',
+            'student_modified', 'faculty_seen', 'faculty_modified' :
+            [seconds since 1970 or 0 if blank, ...], 'grade': [...]}
+            >>> columns = {'due': [1516769940, 1516769940, 0],
+            ...   'submitted': [1516663223, 0, 0], 'grade': ['B', '', ''],
+            ...   'student_seen': [0, 0, 0], 'student_modified': [0, 0, 0],
+            ...   'faculty_seen': [0, 0, 0], 'faculty_modified': [0, 0, 0]}
+            >>> Work.grade_css(columns, faculty_view=True)
+            [('B', 'black'), ('overdue', 'red'), ('…', 'black')]
+        """
+        # The grade will be shown as
+        #    '…'          if not submitted and not yet due
+        #    'overdue'    if not submitted and past due date  ('l͟a͟t͟e͟' for students)
+        #    'ungraded'   if submitted and not graded
+        #    work.grade   if submitted and graded ... or whenever it's set.
+        # See Course.grade_data_grid for the colors.
+        now = Time().epoch if now is None else now
+        grace = 3600 * due_grace_hours
         if faculty_view:
-            if Time(faculty_modified) > Time(student_seen):
-                css_class = 'brown'
-            if Time(student_modified) > Time(faculty_seen):
-                css_class = 'darkgreen'
-            if not self.submitted:
-                if before_due_date:
-                    grade = '…'
-                else:
-                    grade = 'overdue'
-                    css_class = 'red'
-            else:
-                if not self.grade:
-                    grade = 'ungraded'
-                    css_class = 'green'
-                else:
-                    grade = self.grade
+            (late, late_css, ungraded_css) = ('overdue', 'red', 'green')
+            (mine, seen_mine) = ('faculty_modified', 'student_seen')
+            (theirs, seen_theirs) = ('student_modified', 'faculty_seen')
         else:
-            if Time(student_modified) > Time(faculty_seen):
-                css_class = 'brown'
-            if Time(faculty_modified) > Time(student_seen):
-                css_class = 'darkgreen'
-            if not self.submitted:
-                if before_due_date:
-                    grade = '…'
-                else:
-                    grade = 'l͟a͟t͟e͟'  # l͟a͟t͟e͟
-                    css_class = 'green'
+            (late, late_css, ungraded_css) = ('l͟a͟t͟e͟', 'green', 'brown')
+            (mine, seen_mine) = ('student_modified', 'faculty_seen')
+            (theirs, seen_theirs) = ('faculty_modified', 'student_seen')
+        result = []
+        for (due, submitted, grade, mine_modified, mine_seen,
+             theirs_modified, theirs_seen) in zip(
+                columns['due'], columns['submitted'], columns['grade'],
+                columns[mine], columns[seen_mine],
+                columns[theirs], columns[seen_theirs]):
+            if theirs_modified > theirs_seen:
+                css_class = 'darkgreen'     # the viewer hasn't seen changes
+            elif mine_modified > mine_seen:
+                css_class = 'brown'         # the other side hasn't
             else:
-                if not self.grade:
-                    grade = 'ungraded'
-                    css_class = 'brown'
-                else:
-                    grade = self.grade
-        if self.grade:             # If a grade has been assigned, show it. Period.
-            grade = self.grade
-        return (grade, css_class)
+                css_class = 'black'
+            if grade:        # If a grade has been assigned, show it. Period.
+                label = grade
+                if not submitted and due and now >= due + grace:
+                    css_class = late_css
+            elif submitted:
+                (label, css_class) = ('ungraded', ungraded_css)
+            elif due and now >= due + grace:
+                (label, css_class) = (late, late_css)
+            else:
+                label = '…'
+            result.append((label, css_class))
+        return result
+
+# Cached data which other processes may change ; see Generation.
+Generation.watch('person', Person._uncache)
+Generation.watch('admins', lambda name: setattr(Person, '_admins', None))
+Generation.watch('roles', Role._uncache)
+Generation.watch('roles', lambda name: Course._navigations.clear())
+Generation.watch('courses', lambda name: setattr(Course, '_site_course', None))
+
+@contextmanager
+def _example_course(students, assignments, works=False):
+    """ For the doctests : a made up course with this many students
+        and assignments (and optionally a Work for each of them, graded
+        'B'), which is removed from the database afterwards. """
+    with db.atomic() as transaction:
+        course = Course.create(name='Example Course', path='_example')
+        tag = '_example{}'.format(course.course_id)
+        for chunk in chunked(range(students), 100):
+            Person.insert_many([{'username': '{}_{}'.format(tag, i),
+                                 'name': 'Student {:03d}'.format(i)}
+                                for i in chunk]).execute()
+        people = list(Person.select().where(Person.username.startswith(tag)))
+        for chunk in chunked(people, 100):
+            Registration.insert_many([{'course': course, 'person': person,
+                                       'role': Role.by_name('student')}
+                                      for person in chunk]).execute()
+        Assignment.insert_many([{'course': course, 'nth': nth + 1,
+                                 'name': 'assignment {}'.format(nth + 1)}
+                                for nth in range(assignments)]).execute()
+        if works:
+            asses = Assignment.select().where(Assignment.course == course)
+            Work.insert_new([dict(Work.virtual(ass, person).__data__,
+                                  grade='B')
+                             for ass in asses for person in people])
+        try:
+            yield Course.get(course_id=course.course_id)
+        finally:
+            transaction.rollback()
+            Course._snapshots.clear()
+            Person._by_username.clear()
 
 def init_db():
     """ Create base database objects """
@@ -1596,9 +2375,75 @@ def init_db():
     # and admin user role.
     # The sql database must already exist; see bin/init_db .
     # All these are "get_or_create", so running 'em multiple times won't hurt.
+    migrate_db()
     Role.create_defaults()
     Course.create_site()
 
+def migrate_db():
+    """ Add to an existing database anything added to database/umber.sql
+        since it was created ; see bin/umber_migrate_db . """
+    # Safe to run more than once.
+    Generation.create_table(safe=True)
+    # Person generations were once one per username.
+    Generation.delete().where(Generation.name.startswith('person-')).execute()
+    # The *_epoch columns, which are then filled in from the time strings.
+    for model in (Assignment, Work):
+        table = model._meta.table_name
+        columns = {column.name for column in db.get_columns(table)}
+        for epoch_field in model._epoch_fields.values():
+            if epoch_field not in columns:
+                db.execute_sql('ALTER TABLE {} ADD COLUMN {} '
+                               'INTEGER NOT NULL DEFAULT 0'.format(
+                                   table, epoch_field))
+        with db.atomic():
+            for row in model.select():
+                epochs = {epoch_field: epoch_of(getattr(row, field))
+                          for (field, epoch_field)
+                          in model._epoch_fields.items()}
+                if any(getattr(row, epoch_field) != epoch
+                       for (epoch_field, epoch) in epochs.items()):
+                    (model.update(**epochs)
+                          .where(model._meta.primary_key == row.get_id())
+                          .execute())
+    _merge_duplicate_work()
+    for sql in ('CREATE INDEX IF NOT EXISTS assignment_course_due '
+                'ON Assignment(course_id, due_epoch)',
+                'CREATE INDEX IF NOT EXISTS work_assignment_submitted '
+                'ON Work(assignment_id, submitted_epoch)',
+                'CREATE INDEX IF NOT EXISTS work_person ON Work(person_id)',
+                'CREATE UNIQUE INDEX IF NOT EXISTS work_assignment_person '
+                'ON Work(assignment_id, person_id)'):
+        db.execute_sql(sql)
+
+def _merge_duplicate_work():
+    """ Merge any Work rows for the same assignment and person into
+        the first of them, before the work_assignment_person index """
+    # (Before that index, two processes could both create the same Work.)
+    # The latest of each time is kept, and the first grade and notes
+    # which aren't blank.
+    duplicates = (Work.select(Work.assignment, Work.person)
+                      .group_by(Work.assignment, Work.person)
+                      .having(fn.COUNT(Work.work_id) > 1)
+                      .tuples())
+    with db.atomic():
+        for (assignment_id, person_id) in list(duplicates):
+            works = list(Work.select()
+                             .where(Work.assignment == assignment_id,
+                                    Work.person == person_id)
+                             .order_by(Work.work_id))
+            (first, others) = (works[0], works[1:])
+            for other in others:
+                for (field, epoch_field) in Work._epoch_fields.items():
+                    if getattr(other, epoch_field) > getattr(first, epoch_field):
+                        setattr(first, field, getattr(other, field))
+                for field in ('grade', 'notes'):
+                    if not getattr(first, field):
+                        setattr(first, field, getattr(other, field))
+            first.save()
+            (Work.delete()
+                 .where(Work.work_id.in_([work.work_id for work in others]))
+                 .execute())
+
 def populate_production_db(interactive=False):
     """ create initial objects for production database """
     # see umber/bin/init_db
@@ -0,0 +1,122 @@
+"""
+ pagecache.py
+
+ A per-process cache of whole pages as seen by anonymous (not logged in)
+ visitors, so that a burst of visits to a public course page doesn't
+ run Page.get_from_path and render_template for each one.
+
+ Only plain GETs (no ?action etc) of markdown pages which anonymous
+ visitors can read, and which have a validator (see Page.validator),
+ are cached. A cached page is used only while what it was made from
+ is unchanged :
+   * the os.stat (see filestat.py) of the page's file, its attachments
+     folder, the course's sys/navigation.md, and the .access.yaml
+     files in the folders above it ;
+   * the course's snapshot generation (its roster, assignments, ...) ;
+   * the generations of the page's folders, which are bumped whenever
+     gitlocal commits a change within them (in any process) ;
+   * the date, and umber's code version.
+
+ A request with the header "X-Umber-Cache: bypass" doesn't use the
+ cache ; responses from mainroute say "X-Umber-Cache: hit" or "miss".
+ Only the urls that may be markdown pages (see eligible()) are looked
+ up, and a miss is counted when such a page is rendered and cached,
+ so that the hit rate isn't lowered by folders, raw files and so on.
+
+   >>> [eligible(path) for path in ('demo/home', 'demo/notes/',
+   ...                              'demo/code/hello.py', 'demo/sys/grades')]
+   [True, False, False, False]
+   >>> folder_name(os.path.join(os_courses, 'demo', 'home.md'), is_folder=False)
+   'folder-demo'
+"""
+import os
+from collections import OrderedDict
+from settings import os_courses, page_cache_size
+from model import Generation
+from utilities import Time
+import filestat, gitlocal
+
+_pages = OrderedDict()    # {(path, query): (recipe, signature, html, etag)}
+_counts = {'hits': 0, 'misses': 0}
+
+def folder_name(abspath, is_folder):
+    """ Return the Generation name for the folder of a file or folder """
+    folder = abspath if is_folder else os.path.dirname(abspath)
+    return 'folder-' + os.path.relpath(folder, os_courses)
+
+def committed(course, abspaths):
+    """ Bump the generations of the folders that a git commit touched ;
+        see gitlocal.commit_hooks """
+    names = {folder_name(abspath, is_folder=filestat.isdir(abspath))
+             for abspath in abspaths}
+    for name in sorted(names):
+        Generation.bump(name)
+
+gitlocal.commit_hooks.append(committed)
+
+def recipe(page):
+    """ Return (paths, generation names) that a page's html depends on """
+    paths = [page.abspath, page.attachments_folder(),
+             os.path.join(page.course.abspath, 'sys', 'navigation.md')]
+    folder = os.path.dirname(page.abspath)
+    while folder.startswith(os_courses):
+        paths.append(os.path.join(folder, '.access.yaml'))
+        folder = os.path.dirname(folder)
+    names = [page.course._generation_name(),
+             folder_name(page.abspath, is_folder=False),
+             folder_name(page.attachments_folder(), is_folder=True)]
+    return (tuple(paths), tuple(names))
+
+def signature(recipe, code_version):
+    """ Return the current values of the things in a recipe """
+    (paths, names) = recipe
+    stats = []
+    for path in paths:
+        stat = filestat.stat(path)
+        stats.append(stat and (stat.st_mtime_ns, stat.st_size))
+    return (tuple(stats), tuple(Generation.current(name) for name in names),
+            str(Time())[:10], code_version)
+
+def eligible(pagepath):
+    """ Return True if a url path may be a cacheable markdown page,
+        i.e. not a folder, a file with an extension, or a sys page """
+    # (A markdown page's url doesn't have its .md ; see mainroute.)
+    parts = pagepath.split('/')
+    return parts[-1] != '' and os.path.splitext(parts[-1])[1] == '' and \
+           'sys' not in parts
+
+def get(key, code_version):
+    """ Return (html, etag) of a cached page which is still current,
+        or None """
+    entry = _pages.get(key)
+    if entry:
+        (_recipe, _signature, html, etag) = entry
+        if signature(_recipe, code_version) == _signature:
+            _pages.move_to_end(key)
+            _counts['hits'] += 1
+            return (html, etag)
+        del _pages[key]
+    return None
+
+def prepare(page, code_version):
+    """ Return what put() needs to know about a page ; this is called
+        before the page is rendered, so that any change after this
+        makes the cached html out of date. """
+    _recipe = recipe(page)
+    return (_recipe, signature(_recipe, code_version))
+
+def put(key, prepared, html, etag):
+    """ Cache a page's html as rendered for anonymous visitors """
+    (_recipe, _signature) = prepared
+    _counts['misses'] += 1
+    _pages[key] = (_recipe, _signature, html, etag)
+    while len(_pages) > page_cache_size:
+        _pages.popitem(last=False)
+
+def summary():
+    """ Return {'pages', 'hits', 'misses'} for this process """
+    return dict(_counts, pages=len(_pages))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,120 @@
+"""
+ prerender.py
+
+ Render the markdown pages in a course, a term folder, or all
+ of os_courses into the render cache (see rendercache.py),
+ so that the first visitor to each page doesn't wait for it.
+ Pages whose html is already cached are skipped.
+
+ This is run from bin/umber_prerender, e.g.
+
+   $ umber_prerender                # everything in os_courses
+   $ umber_prerender demo fall2024  # a course and a term folder
+   $ umber_prerender -j 4 demo      # with 4 processes
+
+ The files are read (and their ~/ links translated for their course)
+ in this process, which also writes the results to the cache ;
+ only markdown2html runs in the pool of processes.
+
+   >>> notes = markdown_files(os.path.join(os_courses, 'demo', 'notes'))
+   >>> [relpath(abspath) for abspath in notes][:2]
+   ['demo/notes/home.md', 'demo/notes/new_file.md']
+"""
+import os, argparse
+from time import time
+from multiprocessing import Pool
+from settings import os_courses
+from utilities import markdown2html, link_translate
+import model, rendercache
+
+def relpath(abspath):
+    """ Return path within os_courses, e.g. 'demo/home.md' """
+    return os.path.relpath(abspath, os_courses)
+
+def markdown_files(folder):
+    """ Return sorted absolute paths of .md files in and below a folder,
+        skipping invisible folders (e.g. .git) """
+    found = []
+    for (dirpath, dirnames, filenames) in os.walk(folder):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        found += [os.path.join(dirpath, name) for name in sorted(filenames)
+                  if name.endswith('.md') and not name.startswith('.')]
+    return found
+
+def _render(job):
+    """ Return (key, html, error) for one (key, markdown) job ;
+        this runs in the pool's processes. """
+    (key, markdown) = job
+    try:
+        return (key, markdown2html(markdown), None)
+    except Exception as error:
+        return (key, None, repr(error))
+
+def prerender(folders, processes=None, verbose=True):
+    """ Render the markdown files in these folders into the render cache.
+        Return {'files', 'fresh', 'rendered', 'failed', 'seconds'} """
+    start = time()
+    counts = {'files': 0, 'fresh': 0, 'rendered': 0, 'failed': 0}
+    jobs = {}    # {key: relpath} for pages that need rendering
+    for folder in folders:
+        for abspath in markdown_files(folder):
+            counts['files'] += 1
+            course = model.Course.by_path(relpath(abspath))
+            try:
+                with open(abspath, 'rb') as _file:
+                    content = _file.read().decode('utf8')
+                if course is None:
+                    raise ValueError('not in a course')
+            except Exception as error:
+                counts['failed'] += 1
+                print(' failed {} : {}'.format(relpath(abspath), error))
+                continue
+            # the same key as Page.content_as_html
+            content_with_links = link_translate(course, content)
+            key = rendercache.key('markdown', content_with_links)
+            if key in jobs or rendercache.has(key):
+                counts['fresh'] += 1
+            else:
+                jobs[key] = (relpath(abspath), content_with_links)
+    with Pool(processes) as pool:
+        work = [(key, markdown) for (key, (path, markdown)) in jobs.items()]
+        for (key, html, error) in pool.imap_unordered(_render, work,
+                                                      chunksize=8):
+            if error:
+                counts['failed'] += 1
+                print(' failed {} : {}'.format(jobs[key][0], error))
+            else:
+                rendercache.put(key, html)
+                counts['rendered'] += 1
+                if verbose:
+                    print(' rendered {}'.format(jobs[key][0]))
+    counts['seconds'] = time() - start
+    return counts
+
+def main(args):
+    """ bin/umber_prerender """
+    parser = argparse.ArgumentParser(prog='umber_prerender',
+        description='Render course markdown pages into the render cache.')
+    parser.add_argument('paths', nargs='*',
+        help='courses or folders within os_courses (default: all of it)')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+        help='number of processes (default: one per cpu)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help="don't list each page")
+    options = parser.parse_args(args)
+    folders = [os.path.join(os_courses, path) for path in options.paths]
+    missing = [folder for folder in folders if not os.path.isdir(folder)]
+    if missing:
+        parser.error('no such folder : {}'.format(', '.join(missing)))
+    counts = prerender(folders or [os_courses], options.processes,
+                       verbose=not options.quiet)
+    seconds = counts['seconds']
+    print((' {files} pages : {rendered} rendered, {fresh} already cached,'
+           ' {failed} failed').format(**counts))
+    print(' {:.1f} seconds, {:.1f} pages/second rendered'.format(
+          seconds, counts['rendered'] / seconds if seconds else 0))
+    return 1 if counts['failed'] else 0
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
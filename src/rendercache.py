@@ -0,0 +1,224 @@
+"""
+ rendercache.py
+
+ A cache of rendered html (i.e. markdown pages), kept in its own
+ sqlite3 file next to the umber database so that viewing a page
+ never writes to the main database.
+
+ Entries are keyed by a hash of what was rendered - for markdown
+ pages, the text after link_translate (which puts in the course url) -
+ so a page copied unchanged into another semester's course shares
+ its entry unless it has ~/ course links.
+
+ When the entries use more than render_cache_bytes, the least
+ recently used are removed. Each process counts its hits and misses,
+ and adds them to the totals in the cache file now and then.
+
+   >>> k = key('markdown', 'testing *rendercache*')
+   >>> print(get(k))
+   None
+   >>> put(k, '<p>testing <em>rendercache</em></p>')
+   >>> has(k)
+   True
+   >>> get(k)
+   '<p>testing <em>rendercache</em></p>'
+   >>> forget(k)
+   >>> print(get(k))
+   None
+
+ See bin/umber_render_cache to see its statistics or clear it.
+"""
+import atexit
+from time import time
+from peewee import ( SqliteDatabase, Model, TextField, IntegerField,
+                     FloatField, fn, OperationalError )
+from settings import os_render_cache, render_cache_bytes, markdown_engine
+from utilities import md5
+
+# Part of every key ; change it when rendering changes,
+# so that older entries won't be used.
+version = 1
+
+# Reading an entry updates its "last used" time (for the least
+# recently used eviction) at most this often, in seconds ;
+# the hit and miss counts are written out about as often.
+touch_seconds = 60
+
+# Each process adds up the sizes it puts, and only asks the cache file
+# for the total of all the entries (a scan of the whole table) when that
+# estimate is over render_cache_bytes, or after this many of its puts
+# (since other processes put entries too).
+total_puts = 100
+
+cache_db = SqliteDatabase(os_render_cache, pragmas={'journal_mode': 'wal'})
+
+class Render(Model):
+    class Meta:
+        database = cache_db
+        db_table = 'Render'
+
+    key = TextField(primary_key=True)
+    html = TextField()
+    size = IntegerField()
+    used = FloatField(index=True)    # time last read or written
+
+class Counter(Model):
+    class Meta:
+        database = cache_db
+        db_table = 'Counter'
+
+    name = TextField(primary_key=True)   # 'hits' or 'misses'
+    value = IntegerField()
+
+_ready = False                        # tables created ?
+_counts = {'hits': 0, 'misses': 0}    # not yet added to Counter
+_flushed = time()
+_total = None     # estimated bytes of all the entries ; see _evict
+_puts = 0         # puts since _total was last read from the cache file
+
+def _setup():
+    global _ready
+    if not _ready:
+        cache_db.create_tables([Render, Counter], safe=True)
+        _ready = True
+
+def key(kind, text):
+    """ Return the cache key for some kind of rendering of some text
+        (with settings.markdown_engine) """
+    return md5('{} {} {} {}'.format(kind, version, markdown_engine, text))
+
+def get(key):
+    """ Return cached html or None """
+    try:
+        _setup()
+        row = (Render.select(Render.html, Render.used)
+                     .where(Render.key == key).tuples().first())
+        if row is None:
+            _count('misses')
+            return None
+        (html, used) = row
+        _count('hits')
+        if time() - used > touch_seconds:
+            Render.update(used=time()).where(Render.key == key).execute()
+        return html
+    except OperationalError:
+        # e.g. a locked database : just render again
+        return None
+
+def has(key):
+    """ Return True if there's an entry for this key (without counting
+        it as a hit or miss, or marking it as used) """
+    try:
+        _setup()
+        return Render.select().where(Render.key == key).exists()
+    except OperationalError:
+        return False
+
+def put(key, html):
+    """ Store html in the cache """
+    try:
+        _setup()
+        with cache_db.atomic():
+            Render.replace(key=key, html=html, size=len(html),
+                           used=time()).execute()
+        _evict(len(html))
+    except OperationalError:
+        pass
+
+def forget(key):
+    """ Remove one entry """
+    _setup()
+    Render.delete().where(Render.key == key).execute()
+
+def _evict(size):
+    """ Remove least recently used entries if they're too big,
+        after a put of this many bytes """
+    global _total, _puts
+    _puts += 1
+    if _total is not None:
+        _total += size
+        if _total <= render_cache_bytes and _puts < total_puts:
+            return
+    total = Render.select(fn.SUM(Render.size)).scalar() or 0
+    (_total, _puts) = (total, 0)
+    if total <= render_cache_bytes:
+        return
+    # down to 90% of the limit, so this isn't needed on every put
+    goal = total - 0.9 * render_cache_bytes
+    removed = 0
+    oldest = []
+    for (key, size) in (Render.select(Render.key, Render.size)
+                              .order_by(Render.used).tuples()):
+        if removed >= goal:
+            break
+        oldest.append(key)
+        removed += size
+    chunk = 500   # sqlite has a limit on the number of sql variables
+    with cache_db.atomic():
+        for i in range(0, len(oldest), chunk):
+            Render.delete().where(Render.key.in_(oldest[i:i+chunk])).execute()
+    _total = total - removed
+
+def _count(name):
+    _counts[name] += 1
+    if time() - _flushed > touch_seconds:
+        flush()
+
+def flush():
+    """ Add this process's hit and miss counts to the totals """
+    global _flushed
+    _flushed = time()
+    try:
+        _setup()
+        with cache_db.atomic():
+            for (name, value) in _counts.items():
+                Counter.insert(name=name, value=0).on_conflict_ignore().execute()
+                (Counter.update(value=Counter.value + value)
+                        .where(Counter.name == name).execute())
+                _counts[name] = 0
+    except OperationalError:
+        pass
+
+atexit.register(flush)
+
+def stats():
+    """ Return {'entries', 'bytes', 'limit', 'hits', 'misses'} """
+    flush()
+    counts = {name: value for (name, value) in
+              Counter.select(Counter.name, Counter.value).tuples()}
+    return {'entries': Render.select().count(),
+            'bytes': Render.select(fn.SUM(Render.size)).scalar() or 0,
+            'limit': render_cache_bytes,
+            'hits': counts.get('hits', 0),
+            'misses': counts.get('misses', 0)}
+
+def clear():
+    """ Remove all entries and reset the counts """
+    global _total
+    _setup()
+    _total = None
+    with cache_db.atomic():
+        Render.delete().execute()
+        Counter.delete().execute()
+    for name in _counts:
+        _counts[name] = 0
+
+def command(args):
+    """ bin/umber_render_cache : print statistics, or 'clear' """
+    if args == ['clear']:
+        clear()
+        print(' render cache cleared')
+    elif args in ([], ['stats']):
+        data = stats()
+        lookups = data['hits'] + data['misses']
+        print(' render cache {}'.format(os_render_cache))
+        print('   entries : {}'.format(data['entries']))
+        print('   size    : {} of {} bytes'.format(data['bytes'],
+                                                   data['limit']))
+        print('   hits    : {} of {} lookups'.format(data['hits'], lookups))
+    else:
+        print(' usage: umber_render_cache [stats | clear]')
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
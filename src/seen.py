@@ -0,0 +1,252 @@
+"""
+ seen.py
+
+ A write-behind buffer for the times that a student or faculty member
+ last saw a work page (Work.student_seen and Work.faculty_seen), so
+ that viewing a work page doesn't write to the database.
+
+ mark() sets the time on the Work in memory, keeps it in this process
+ (merged with any earlier mark of the same work and field), and
+ appends it to this process's journal file in the os_seen_journal
+ folder. flush() then writes all the marks in one transaction, and
+ takes the flushed marks out of the journal. A flush happens
+   * at the end of a request (umber.py calls maybe_flush()) once the
+     oldest mark is seen_flush_seconds old ;
+   * from a timer, seen_flush_seconds after a mark, so that a process
+     which gets no more requests doesn't keep its marks ;
+   * when the process exits.
+ The journal of a process which didn't exit cleanly (e.g. a killed
+ uwsgi worker), or which hasn't been written for seen_stale_seconds,
+ is replayed by the next flush in any other process.
+
+ The journal is named for the process that opens it at its first
+ mark, so that uwsgi workers forked from one master each have their
+ own.
+
+ Until a mark is flushed, other processes see the older time ;
+ apply() puts this process's marks onto a Work read from the database.
+
+ A Work which doesn't exist yet (see Assignment.find_work) is created
+ by the flush.
+
+   >>> marks = {}
+   >>> merge(marks, (1, 2, 'faculty_seen'), '2018-01-28T16:00:00-05:00')
+   >>> merge(marks, (1, 2, 'faculty_seen'), '2018-01-27T16:00:00-05:00')
+   >>> marks
+   {(1, 2, 'faculty_seen'): (1517173200, '2018-01-28T16:00:00-05:00')}
+"""
+import os, json, atexit, threading
+from time import time
+from peewee import OperationalError
+from settings import os_seen_journal, seen_flush_seconds
+from utilities import Time, print_debug
+
+fields = ('student_seen', 'faculty_seen')
+
+# A journal which hasn't been written for this long belongs to a stuck
+# process, or to a stopped one whose pid has been reused.
+seen_stale_seconds = 60 * seen_flush_seconds
+
+_lock = threading.RLock()  # flush() may run in the timer thread
+_pid = None       # the process which _pending, _journal and _timer belong to
+_pending = {}     # {(assignment_id, person_id, field): (epoch, time string)}
+_oldest = None    # when the oldest unflushed mark was made
+_journal = None   # this process's journal file, once it has made a mark
+_timer = None     # the threading.Timer which will flush, if any
+_looked = 0       # when other processes' journals were last looked for
+
+def merge(marks, key, when, epoch=None):
+    """ Put a time into {key: (epoch, when)} unless it has a later one """
+    if epoch is None:
+        epoch = int(Time(when).epoch)
+    if key not in marks or marks[key][0] < epoch:
+        marks[key] = (epoch, when)
+
+def _this_process():
+    """ Start over if this is a new (e.g. forked) process """
+    global _pid, _pending, _oldest, _journal, _timer
+    if _pid != os.getpid():
+        # (The marks of the process this was forked from are its own.)
+        _pid = os.getpid()
+        (_pending, _oldest, _journal, _timer) = ({}, None, None, None)
+
+def _line(key, mark):
+    (epoch, when) = mark
+    return json.dumps(list(key) + [when, epoch]) + '\n'
+
+def mark(work, field, when):
+    """ Set work.<field> (e.g. 'faculty_seen') to a time string,
+        and write it to the database later """
+    global _oldest, _journal, _timer
+    epoch = int(Time(when).epoch)
+    setattr(work, field, when)
+    setattr(work, field + '_epoch', epoch)
+    key = (work.assignment_id, work.person_id, field)
+    with _lock:
+        _this_process()
+        merge(_pending, key, when, epoch)
+        if _oldest is None:
+            _oldest = time()
+        if _journal is None:
+            _journal = os.path.join(os_seen_journal, '{}-{}.jsonl'.format(
+                _pid, int(1000 * time())))
+        try:
+            os.makedirs(os_seen_journal, exist_ok=True)
+            with open(_journal, 'a') as journal:
+                journal.write(_line(key, (epoch, when)))
+        except OSError:
+            pass
+        if _timer is None:
+            _timer = threading.Timer(seen_flush_seconds, _on_timer)
+            _timer.daemon = True
+            _timer.start()
+
+def apply(work):
+    """ Put this process's unflushed marks onto a Work """
+    with _lock:
+        _this_process()
+        for field in fields:
+            entry = _pending.get((work.assignment_id, work.person_id, field))
+            if entry and entry[0] > (getattr(work, field + '_epoch') or 0):
+                (epoch, when) = entry
+                setattr(work, field, when)
+                setattr(work, field + '_epoch', epoch)
+
+def _on_timer():
+    """ Flush from the timer thread, with its own database connection """
+    global _timer
+    from model import db    # (model.py imports this)
+    with _lock:
+        _timer = None
+    try:
+        flush()
+    finally:
+        if not db.is_closed():
+            db.close()
+    with _lock:
+        if _pending and _timer is None:
+            # e.g. the database was locked : try again later
+            _timer = threading.Timer(seen_flush_seconds, _on_timer)
+            _timer.daemon = True
+            _timer.start()
+
+def _orphans():
+    """ Return the journal files of processes which have stopped,
+        or which haven't written them for seen_stale_seconds """
+    try:
+        filenames = os.listdir(os_seen_journal)
+    except OSError:
+        return []
+    paths = []
+    for filename in filenames:
+        path = os.path.join(os_seen_journal, filename)
+        if path == _journal or not filename.endswith('.jsonl'):
+            continue
+        try:
+            pid = int(filename.split('-')[0])
+            if pid == os.getpid() or \
+               time() - os.stat(path).st_mtime > seen_stale_seconds:
+                paths.append(path)   # e.g. an earlier process with this pid
+            else:
+                os.kill(pid, 0)
+        except ProcessLookupError:
+            paths.append(path)
+        except (ValueError, OSError):
+            pass             # e.g. a process of another user : running
+    return paths
+
+def maybe_flush():
+    """ Flush if the oldest mark is old enough, or if there are
+        journals left by stopped processes (looked for every
+        seen_flush_seconds) """
+    global _looked
+    with _lock:
+        _this_process()
+        due = _oldest is not None and time() - _oldest >= seen_flush_seconds
+        if not due and time() - _looked >= seen_flush_seconds:
+            _looked = time()
+            due = bool(_orphans())
+    if due:
+        flush()
+
+def flush():
+    """ Write the marks of this process, and of stopped processes'
+        journals, to the database ; return how many were written """
+    # The lock isn't held while writing, which may wait for a busy
+    # database, so that mark() and apply() in other threads don't wait.
+    global _oldest
+    with _lock:
+        _this_process()
+        marks = dict(_pending)
+        orphans = _orphans()
+    for path in orphans:
+        try:
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        (assignment_id, person_id, field, when, epoch) = \
+                            json.loads(line)
+                    except ValueError:
+                        continue     # e.g. a half written last line
+                    merge(marks, (assignment_id, person_id, field),
+                          when, epoch)
+        except OSError:
+            pass
+    if marks:
+        try:
+            _write(marks)
+        except OperationalError as error:
+            # e.g. a locked database : try again later
+            print_debug(' seen.flush failed : {}'.format(error))
+            return 0
+    with _lock:
+        for (key, mark) in marks.items():
+            if _pending.get(key) == mark:
+                del _pending[key]
+        if not _pending:
+            _oldest = None
+        for path in orphans:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        _rewrite_journal()
+    return len(marks)
+
+def _rewrite_journal():
+    """ Leave only this process's unflushed marks in its journal """
+    if _journal is None:
+        return
+    try:
+        if _pending:
+            with open(_journal + '.new', 'w') as journal:
+                for (key, mark) in _pending.items():
+                    journal.write(_line(key, mark))
+            os.replace(_journal + '.new', _journal)
+        else:
+            os.remove(_journal)
+    except OSError:
+        pass
+
+def _write(marks):
+    """ Update (or create) the Work rows for some marks """
+    from model import db, Work    # (model.py imports this)
+    cells = {(a, p) for (a, p, field) in marks}
+    with db.atomic('IMMEDIATE'):
+        # A blank Work for each which doesn't have one yet ...
+        Work.insert_new([Work.virtual(a, p).__data__ for (a, p) in cells])
+        # ... and then the times, which are only ever moved forward.
+        cursor = db.cursor()
+        for field in fields:
+            cursor.executemany(
+                'UPDATE Work SET {0} = ?, {0}_epoch = ? WHERE assignment_id = ?'
+                ' AND person_id = ? AND {0}_epoch < ?'.format(field),
+                [(when, epoch, a, p, epoch)
+                 for ((a, p, _field), (epoch, when)) in marks.items()
+                 if _field == field])
+
+atexit.register(flush)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
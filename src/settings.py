@@ -43,6 +43,50 @@ localtimezone = 'US/Eastern'
 # assignments aren't until after midnight ;  see model.py
 due_grace_hours = 6
 
+# number of recent requests kept (per page kind and stage)
+# for the percentiles on the admin sys/timing page ; see timing.py
+timing_window = 1000
+
+# longest time (in seconds) that a cached os.stat of a course file
+# is trusted before checking it again ; see filestat.py .
+# (Umber's own writes, new files and deleted files are seen sooner.)
+file_stat_seconds = 5
+
+# most paths whose stats (and .access.yaml rules) each process remembers ;
+# beyond this they're all forgotten and read again. See filestat.py .
+file_stat_cache_size = 20000
+
+# rendered html (see rendercache.py) is cached in this sqlite3 file,
+# and least recently used pages are dropped beyond this many bytes.
+os_render_cache = os_db + '.rendercache'
+render_cache_bytes = 64 * 1024 * 1024
+
+# the times that work pages were last seen are written to the database
+# in batches, this many seconds apart ; until then each process keeps
+# them in a journal file in this folder. See seen.py .
+os_seen_journal = os_db + '.seen'
+seen_flush_seconds = 10
+
+# which library turns markdown into html ; one of the names in
+# utilities.markdown_engines : 'markdown2' (the default, which the
+# docs and demo pages are written for), 'markdown-it' or 'mistune'.
+# The others must be pip installed ; see misc/markdown_engines.py
+# for how their output and speed compare.
+markdown_engine = 'markdown2'
+
+# code files (e.g. hello.py?html) bigger than this are shown
+# without syntax highlighting ; see utilities.pygmentize .
+pygments_max_bytes = 256 * 1024
+
+# most template fragments cached by each process ; see fragments.py
+fragment_cache_size = 2000
+
+# most pages cached by each process for anonymous visitors ; see pagecache.py
+page_cache_size = 500
+
+# most parsed database times remembered by each process ; see utilities.Time
+time_memo_size = 10000
+
 # The 'Umber' course has site docs, home, etc; this is its course URL path.
 site_course_path = 'umber'
 site_home = 'docs/home'
@@ -0,0 +1,162 @@
+"""
+ timing.py
+
+ Per-request timing of the stages of a page view.
+
+ Each request to mainroute is timed in pieces : the stages of
+ Page.get_from_path (file properties, course, access, ...),
+ the template render, and the number of sql queries.
+ When the request finishes, those numbers are added to rolling
+ windows of the most recent samples for that kind of page
+ (markdown, folder, sys, raw, work, or cached ; see pagecache.py),
+ from which percentiles are computed for the admin sys/timing page
+ and its ?json dump.
+
+   >>> start_request()
+   >>> with stage('get_course'):
+   ...     count_query()
+   >>> finish_request('markdown')
+   >>> data = summary()
+   >>> data['kinds']['markdown']['count']
+   1
+   >>> data['kinds']['markdown']['stages']['queries']['max']
+   1
+   >>> 'get_course' in data['kinds']['markdown']['stages']
+   True
+   >>> reset()
+
+ Stages nest : a folder page calls Page.get_from_path for each child
+ while its template is rendering, so those children's stage times
+ are included both in their own stages and in 'render'.
+
+ The numbers are per process : each uwsgi worker keeps its own.
+"""
+import os, threading
+from time import perf_counter, time
+from collections import deque
+from settings import timing_window
+
+page_kinds = ('markdown', 'folder', 'sys', 'raw', 'work', 'cached')
+
+# The order that stages are displayed in templates/sys/timing.html ;
+# anything else recorded will be listed after these.
+stage_names = ('file_properties', 'get_course', 'get_access',
+               'user_permissions', 'revision_data', 'attachments',
+               'work', 'raw', 'render', 'total', 'queries')
+
+_local = threading.local()   # this request's numbers
+_samples = {}                # {kind: {stage: deque of recent samples}}
+_counts = {}                 # {kind: number of requests}
+_since = time()              # start of this process's numbers
+
+def start_request():
+    """ Begin timing a request """
+    _local.stages = {}
+    _local.queries = 0
+    _local.start = perf_counter()
+
+def is_active():
+    """ Return True if a request is being timed in this thread """
+    return getattr(_local, 'stages', None) is not None
+
+class stage:
+    """ Context manager which adds its elapsed time to a named stage
+        of the current request, i.e. "with stage('get_access'): ..." """
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+    def __exit__(self, *exception):
+        if is_active():
+            elapsed = perf_counter() - self.start
+            _local.stages[self.name] = _local.stages.get(self.name, 0) + elapsed
+        return False
+
+def count_query():
+    """ Increment the current request's sql query count """
+    if is_active():
+        _local.queries += 1
+
+def query_count():
+    """ Return the current request's sql query count so far """
+    if is_active():
+        return _local.queries
+    return 0
+
+def finish_request(kind):
+    """ Store this request's numbers under the given kind of page.
+        A kind of None discards them (e.g. redirects). """
+    if not is_active():
+        return
+    stages = _local.stages
+    stages['total'] = perf_counter() - _local.start
+    queries = _local.queries
+    _local.stages = None
+    if not kind:
+        return
+    samples = _samples.setdefault(kind, {})
+    for (name, seconds) in stages.items():
+        if name not in samples:
+            samples[name] = deque(maxlen=timing_window)
+        samples[name].append(seconds * 1000.0)       # milliseconds
+    if 'queries' not in samples:
+        samples['queries'] = deque(maxlen=timing_window)
+    samples['queries'].append(queries)
+    _counts[kind] = _counts.get(kind, 0) + 1
+
+def reset():
+    """ Forget all recorded numbers """
+    global _since
+    _samples.clear()
+    _counts.clear()
+    _since = time()
+
+def percentile(sorted_values, fraction):
+    """ Return the value at a fraction (0 to 1) of a sorted list
+        >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 0.5)
+        5
+        >>> percentile([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 0.9)
+        9
+        >>> percentile([], 0.5)
+        0
+    """
+    if not sorted_values:
+        return 0
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+def _ordered(names):
+    """ Return stage names in display order """
+    known = [name for name in stage_names if name in names]
+    return known + sorted(name for name in names if name not in stage_names)
+
+def summary():
+    """ Return this process's numbers as a json-friendly dict :
+        {'pid', 'since', 'window',
+         'kinds': {kind: {'count',
+                          'stages': {stage: {'n','p50','p90','p99','max'}}}}}
+        with times in milliseconds. """
+    kinds = {}
+    for kind in _ordered_kinds():
+        stages = {}
+        for name in _ordered(_samples[kind]):
+            values = sorted(_samples[kind][name])
+            stages[name] = {'n':   len(values),
+                            'p50': percentile(values, 0.50),
+                            'p90': percentile(values, 0.90),
+                            'p99': percentile(values, 0.99),
+                            'max': values[-1] if values else 0}
+        kinds[kind] = {'count': _counts.get(kind, 0), 'stages': stages}
+    return {'pid': os.getpid(),
+            'since': _since,
+            'window': timing_window,
+            'kinds': kinds}
+
+def _ordered_kinds():
+    known = [kind for kind in page_kinds if kind in _samples]
+    return known + sorted(kind for kind in _samples if kind not in page_kinds)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
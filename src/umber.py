@@ -8,27 +8,39 @@
 import sys, re, os, json, safe, requests
 from authlib.integrations.flask_client import OAuth
 from flask import ( Flask, Response, request, session, g, redirect, url_for, 
-                    abort, flash, get_flashed_messages, render_template )
+                    abort, flash, get_flashed_messages, render_template,
+                    make_response )
 from flask_login import LoginManager, login_user, logout_user, current_user
 from werkzeug import secure_filename
+from werkzeug.http import is_resource_modified
 from time import sleep
-from model import ( db, Person, Role, Course, 
+from datetime import datetime
+from model import ( db, Person, Role, Course, Generation,
                     Registration, Assignment, Work, Page, Time )
 from utilities import ( in_console, split_url, static_url, size_in_bytes,
                         is_clean_folder_name, parse_access_string,
-                        parse_assignment_data, print_debug, pygmentize,
-                        name_to_htmltitle, path_to_startdate )
+                        parse_assignment_data, print_debug,
+                        name_to_htmltitle, path_to_startdate, md5 )
 from settings import ( umber_flask_configure, umber_url, contact_url,
                        help_url, about_url, site_url, url_base, os_root,
                        umber_debug, route_prefix, os_courses, markup_url,
                        site_course_path, site_home, GOOGLE_DISCOVERY_URL,
                        umber_authentication )
-import gitlocal
+import gitlocal, timing, filestat, fragments, pagecache, seen
 
 app = Flask('umber',
             static_folder=os.path.join(os_root, 'static'),
             template_folder=os.path.join(os_root, 'templates'))
 umber_flask_configure(app)
+app.jinja_env.add_extension(fragments.FragmentCache)   # {% cache ... %}
+
+# Part of each page's ETag, so that a new version of umber's
+# templates or code isn't hidden by browsers' cached pages.
+code_version = md5(' '.join(str(os.stat(os.path.join(folder, name)).st_mtime_ns)
+                            for folder in (app.template_folder,
+                                           os.path.join(os_root, 'src'))
+                            for name in sorted(os.listdir(folder))
+                            if name.endswith(('.html', '.py'))))
 
 login_manager = LoginManager()
 login_manager.anonymous_user = Person.get_anonymous
@@ -51,6 +63,17 @@ def load_user(user_session_id):
     # TODO : set logged_in and role correctly ... save in database??
     return user
 
+def not_modified(etag, lastmodified=None):
+    """ Return a '304 not modified' response if the browser's copy
+        is current (If-None-Match, If-Modified-Since), else None. """
+    if is_resource_modified(request.environ, etag=etag,
+                            last_modified=lastmodified):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 def get_message():
     # Intended for user interface messages, e.g. "incorrect login"
     messages = get_flashed_messages()
@@ -72,19 +95,28 @@ def template_context():
                 pwd = os.getcwd,
                 Person = Person,
                 Course = Course,
-                Role = Role
+                Role = Role,
+                Timing = timing,
+                Fragments = fragments,
+                PageCache = pagecache
                )
 
 @app.before_request
 def do_before_request():
     """ initialize database and session """
 
+    timing.start_request()
+    filestat.new_request()
+
     # See http://docs.peewee-orm.com/en/latest/peewee/database.html .
     # This gives "connection already open" error if in console.
     # The current (kludgy) fix is to test for the console explicitly.
     if not in_console():
         db.connect()
 
+    # Find out what cached data other processes have changed.
+    Generation.refresh()
+
     #print " db={}".format(db)
     #print " request={}".format(request)
 
@@ -108,8 +140,16 @@ def do_before_request():
     ## Test passing parameters.
     #session['test'] = 'testing session'       # request thread variable
 
+@app.after_request
+def do_timing(response):
+    """ record this request's stage times under g.timing_kind """
+    # (g.timing_kind is only set by mainroute for pages it serves.)
+    timing.finish_request(g.get('timing_kind', None))
+    return response
+
 @app.teardown_request
 def do_after_request(exception=None):
+    seen.maybe_flush()
     db.close()
 
 # -- upload tests ---
@@ -197,6 +237,25 @@ def mainroute(pagepath):
             redirect_url += '?' + query
         print_debug('redirecting to "{}"'.format(redirect_url))
         return redirect(redirect_url)
+
+    # Anonymous visitors may get a cached copy of a public page ;
+    # see pagecache.py.
+    cache_key = None
+    if request.method == 'GET' and not request.args and \
+       not current_user.is_authenticated() and \
+       not session.get('_flashes') and \
+       request.headers.get('X-Umber-Cache') != 'bypass' and \
+       pagecache.eligible(pagepath):
+        cache_key = (pagepath, request.query_string)
+        cached = pagecache.get(cache_key, code_version)
+        if cached:
+            g.timing_kind = 'cached'
+            (html, etag) = cached
+            response = not_modified(etag) or make_response(html)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.headers['X-Umber-Cache'] = 'hit'
+            return response
     
     # Get the corresponding Page object and its file settings.
     page = Page.get_from_path(pagepath,
@@ -237,7 +296,7 @@ def mainroute(pagepath):
     # for the special "hide this folder" file.)
     if page.is_dir:
         for index in ('indexy.md', 'indexy.html'):
-            if os.path.exists(os.path.join(page.abspath, index)):
+            if filestat.exists(os.path.join(page.abspath, index)):
                     indexpath = os.path.join(pagepath, index)
                     return redirect(url_for('mainroute', pagepath=indexpath))
     
@@ -294,26 +353,77 @@ def mainroute(pagepath):
         print_debug('   page.name_with_ext = {}'.format(page.name_with_ext))
         print_debug('   page.path = {}'.format(page.path))
         print_debug('   request.args = {}'.format(str(request.args)))
-        _content = page.content()
-        _mimetype = page.get_mimetype()
-        if 'html' in request.args:
-            print_debug('   pygmentizing ...')
-            html = pygmentize(_content, filename=page.name_with_ext)
-            _mimetype = 'text/html'
-        else:
-            html = _content  # pass along unchanged
-        return Response(html, mimetype=_mimetype)
-
+        g.timing_kind = 'raw'
+        with timing.stage('raw'):
+            # Files (not git revisions) have validators, so that the
+            # browser's copy can be reused without sending it again.
+            stat = None if page.revision else filestat.stat(page.abspath)
+            if stat:
+                etag = '{:x}-{:x}-{:x}'.format(stat.st_ino, stat.st_size,
+                                               stat.st_mtime_ns)
+                if 'html' in request.args:
+                    etag += '-html'
+                lastmodified = datetime.utcfromtimestamp(int(stat.st_mtime))
+                response = not_modified(etag, lastmodified)
+                if response:
+                    return response
+            _mimetype = page.get_mimetype()
+            if 'html' in request.args:
+                print_debug('   pygmentizing ...')
+                html = page.highlighted_html()
+                _mimetype = 'text/html'
+            else:
+                html = page.content()  # pass along unchanged
+            response = Response(html, mimetype=_mimetype)
+            if stat:
+                response.set_etag(etag)
+                response.last_modified = lastmodified
+                response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    elif page.is_sys and page.relpath == 'sys/timing' and \
+         'json' in request.args and page.can['read']:
+
+        # machine readable version of the admin sys/timing page
+        return Response(json.dumps(dict(timing.summary(),
+                                        fragments=fragments.summary(),
+                                        pagecache=pagecache.summary()),
+                                   indent=1),
+                        mimetype='application/json')
+        
     else:
 
         # umber page : folder or *.md or sys/* 
-        return render_template('main.html',
-                               name = 'main',
-                               page = page,
-                               user = page.user,
-                               course = page.course,
-                               debug = True
-                               )
+        g.timing_kind = page.timing_kind()
+        # Markdown pages have an ETag (see Page.validator), unless
+        # there's a message (e.g. "incorrect login") waiting to be shown.
+        etag = None
+        if request.method == 'GET' and not request.args and \
+           not session.get('_flashes'):
+            validator = page.validator()
+            if validator:
+                etag = md5(code_version + validator)
+                response = not_modified(etag)
+                if response:
+                    return response
+        cacheable = cache_key and etag and page.can['read']
+        if cacheable:
+            prepared = pagecache.prepare(page, code_version)
+        with timing.stage('render'):
+            response = make_response(render_template('main.html',
+                                   name = 'main',
+                                   page = page,
+                                   user = page.user,
+                                   course = page.course,
+                                   debug = True
+                                   ))
+        if etag:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+        if cacheable:
+            pagecache.put(cache_key, prepared, response.get_data(), etag)
+            response.headers['X-Umber-Cache'] = 'miss'
+        return response
 
 # --- debugging route : any url -----------
 #@app.route('/', defaults={'path':''})
@@ -362,6 +472,7 @@ def ajax_upload():
         if not os.path.exists(abspath):
             try:
                 os.mkdir(abspath)
+                filestat.forget(abspath)
             except:
                 print_debug(' submit_createfolder: os.makedir failed')
                 return ajax_response(False, 'error creating attachments folder') 
@@ -373,6 +484,7 @@ def ajax_upload():
         destination = os.path.join(abspath, filename)
         print_debug(f"   ajax_response destination='{destination}'")
         upload.save(destination)
+        filestat.forget(destination)
         gitlocal.add_commit(page, abspath=destination)
 
     print_debug(" sending ajax response ")
@@ -543,7 +655,11 @@ def submit_grades():
     """ handle setting all course grades from grid """
     print_debug('submit grades')
     print_debug(request.form)
-    Work.edit_grades(request.form)
+    results = Work.edit_grades(request.form)
+    counts = {}
+    for result in results.values():
+        counts[result] = counts.get(result, 0) + 1
+    print_debug(' submit_grades : {}'.format(counts))
     return url_for('mainroute', pagepath=request.page.path)
 
 def submit_permissions():
@@ -580,34 +696,38 @@ def submit_edit():
     #  }
     #
     # If this is a work page, then update the Work database object.
-    # (The Work object is created in Page.get_from_path)
+    # (page.work from Page.get_from_path may not be in the database yet,
+    # see Assignment.find_work, or may have been changed since by another
+    # process ; so it's read again, or created, within this transaction.)
     if request.page.is_work:
         now = str(Time())  # string with current time
-        with db.atomic():
-            if request.page.user_role.name == 'faculty':
-                page = request.page
-                page.work.faculty_modified = now
+        page = request.page
+        with db.atomic('IMMEDIATE'):
+            work = page.work_assignment.get_work(page.work_person)
+            if page.user_role.name == 'faculty':
+                work.faculty_modified = now
                 # If checkbox for 'submitted' and that didn't have a value,
                 # then set it - used to mark work as submitted,
                 # i.e. student emails work & faculty submits.
                 if "submitted_checkbox" in request.form \
-                     and not page.work.submitted:
+                     and not work.submitted:
                     due = Time(page.work_due)
                     print_debug(" submit_edit: due = {}".format(str(due)))
                     if "on_time_checkbox" in request.form:
                         due.shift_minutes(-5)
                     else:
                         due.shift_minutes(5)
-                    page.work.submitted = str(due)
+                    work.submitted = str(due)
                     print_debug(" submit_edit: submitted set to {}".format( \
-                                page.work.submitted))
+                                work.submitted))
                 if 'grade' in request.form:
-                    page.work.grade = str(request.form['grade'])
+                    work.grade = str(request.form['grade'])
             else:
-                request.page.work.student_modified = now
-                if not request.page.work.submitted:
-                    request.page.work.submitted = now    
-            request.page.work.save()
+                work.student_modified = now
+                if not work.submitted:
+                    work.submitted = now    
+            work.save()
+            page.work = work
     # Save the page content to a file and to git.
     bytes_written = request.page.write_content(request.form['edit_text'])
     print_debug(' submit_edit: bytes_written = {}'.format(bytes_written))
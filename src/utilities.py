@@ -3,12 +3,21 @@
 """
 import parsedatetime, pytz, random, hashlib
 import os, shutil, urllib.parse, arrow, string, re, io
+from html import escape as html_escape
 from flask import url_for, app
 from markdown2 import markdown
-from settings import ( url_base, debug_logfilename,
-                       localtimezone, umber_debug, static_prefix )
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name, guess_lexer, \
+                            guess_lexer_for_filename
+from pygments.util import ClassNotFound
+from settings import ( url_base, debug_logfilename, markdown_engine,
+                       localtimezone, umber_debug, static_prefix,
+                       pygments_max_bytes, time_memo_size )
 from flask import url_for, app
 from dateutil.parser import parse as dateutil_parse
+from dateutil.tz import gettz
+from datetime import datetime, timezone
 import logging
 
 # So I wanted to be able to toggle it off for doctests and setup ...
@@ -120,6 +129,12 @@ class Time:
         >> print(Time(license_lastmodified))
         2018-01-13T16:45:54-05:00
 
+        >>> when = Time('2018-07-10T18:01:33-04:00')
+        >>> (str(when), when.daydatetimesec(), when.assignISOdate())
+        ('2018-07-10T18:01:33-04:00', 'Tue Jul 10 2018 06:01:33 pm', '2018-07-10 6:01 pm')
+        >>> (when < Time(when.epoch + 1), when == Time(str(when)))
+        (True, True)
+
     """
     # Uses the python Arrow library; see http://crsmithdev.com/arrow/  .
     #
@@ -184,107 +199,159 @@ class Time:
                 pass
         return result
             
+    # A Time is stored as its seconds since 1970 (self.epoch), which is
+    # what comparisons use, and its local datetime (self.when), which
+    # is what the formatting uses ; an arrow is made only when needed.
+    # Database (ISO) strings and timestamps are converted once and
+    # then remembered, in Time._memo .
+    _memo = {}          # {ISO string or timestamp: (epoch, when)}
+    _tz = gettz(localtimezone)
+
     def __init__(self, datetimestring=None):
+        self._arrow = None
+        if datetimestring == None or datetimestring == '':
+            # use the "now" time.
+            self._set(Time._localize(datetime.now(timezone.utc)))
+            return
+        memo = Time._memo.get(datetimestring)
+        if memo:
+            (self.epoch, self.when) = memo
+            return
+        remember = False
         try:
             if is_number(datetimestring):
                 # unix timestamp i.e. seconds since epoch,
                 # returned by os.stat file statistics.
-                self.arrow = arrow.Arrow.fromtimestamp(datetimestring)
-            elif datetimestring == None or datetimestring == '':
-                # use the "now" time.
-                self.arrow = arrow.get()
+                when = arrow.Arrow.fromtimestamp(datetimestring).datetime
+                remember = True
             elif is_iso_utc(datetimestring):
                 # matches the database ISO8601 format with timezone,
                 # so don't send it through the parser - just use it.
-                self.arrow = arrow.get(datetimestring)
+                try:
+                    when = datetime.fromisoformat(datetimestring)
+                except ValueError:
+                    when = arrow.get(datetimestring).datetime
+                remember = True
             else:
                 parsed = Time._parse(datetimestring)
                 parsed = re.sub(r'\.\d+', '', parsed) # remove decimal seconds
-                self.arrow = arrow.get(parsed)
+                when = arrow.get(parsed).datetime
         except:
             # if all else fails, use current time
-            self.arrow = arrow.get() 
-        # Set timezone using the umber localtimezone from settings.py
-        # (This .replace() method doesn't change d:h:m:s,
-        #  so we also need to shift the time to match the timezone shift.)
-        # But if the time is the default end of day (23:59:00),
-        # leave that as is.
-        local_arrow = self.arrow.replace(tzinfo=localtimezone)
-        if not Time.default24time in local_arrow.isoformat():
-            offset = self.arrow - local_arrow
-            self.arrow = local_arrow + offset
-        else:
-            self.arrow = local_arrow
+            when = datetime.now(timezone.utc)
+        self._set(Time._localize(when))
+        if remember:
+            if len(Time._memo) >= time_memo_size:
+                Time._memo.clear()
+            Time._memo[datetimestring] = (self.epoch, self.when)
+
+    @staticmethod
+    def _localize(when):
+        """ Return a timezone-aware datetime in the umber localtimezone
+            from settings.py """
+        # The local clock time is first set to that of when,
+        # then shifted by the difference in their utc offsets ...
+        # except at the default end of day (23:59:00), which is left
+        # as is. (Shifting the clock time rather than the moment is what
+        # adding to an arrow.Arrow does, so this matches the earlier
+        # arrow version of this class, even near daylight savings.)
+        clock = when.replace(tzinfo=None)
+        local = clock.replace(tzinfo=Time._tz)
+        if Time.default24time in local.isoformat():
+            return local
+        clock += local.utcoffset() - when.utcoffset()
+        return clock.replace(tzinfo=Time._tz)
+
+    def _set(self, when):
+        self.when = when
+        self.epoch = when.timestamp()
+
+    @property
+    def arrow(self):
+        """ Return as an arrow.Arrow in the umber localtimezone """
+        if self._arrow is None:
+            self._arrow = arrow.Arrow.fromdatetime(self.when)
+        return self._arrow
+
+    @arrow.setter
+    def arrow(self, value):
+        self._arrow = value
+        self._set(value.datetime)
 
     def __lt__(self, other):
         try:
-            return self.arrow < other.arrow
+            return self.epoch < other.epoch
         except:
             return False
     def __le__(self, other):
         try:
-            return self.arrow <= other.arrow
+            return self.epoch <= other.epoch
         except:
             return False
     def __gt__(self, other):
         try:
-            return self.arrow > other.arrow
+            return self.epoch > other.epoch
         except:
             return False
     def __ge__(self, other):
         try:
-            return self.arrow >= other.arrow
+            return self.epoch >= other.epoch
         except:
             return False
     def __eq__(self, other):
         try:
-            return self.arrow == other.arrow
+            return self.epoch == other.epoch
         except:
             return False
     def __ne__(self, other):
         try:
-            return self.arrow != other.arrow
+            return self.epoch != other.epoch
         except:
             return False
     def __str__(self):
         """ ISO representation rounded down to the nearest second """
-        return self.arrow.floor('second').isoformat()
+        return self.when.replace(microsecond=0).isoformat()
+    def format(self, form):
+        """ Return formatted with arrow's tokens, e.g. 'YYYY-MM-DD' ;
+            only those used here are supported """
+        return _time_tokens.sub(
+            lambda match: _time_formats[match.group(0)](self.when), form)
     def human(self):
         """ Return in human friendly form, e.g. 'seconds ago'"""
         return self.arrow.humanize()
     def date(self):
         """ Return as e.g. 'May 09 2013' """
-        return self.arrow.format('MMMM DD YYYY')
+        return self.format('MMMM DD YYYY')
     def isodate(self):
-        return self.arrow.format('YYYY-MM-DD')
+        return self.format('YYYY-MM-DD')
     def daydatetime(self):
         """ Return as e.g. 'Sun May 9 2013 4:10 pm' """
-        return self.arrow.format('ddd MMMM D YYYY h:mm a')
+        return self.format('ddd MMMM D YYYY h:mm a')
     def datetime(self):
         """ Return as fixed length e.g. 'Oct 09 2013 04:10 pm' """
-        return self.arrow.format('ddd MMM DD YYYY hh:mm a')
+        return self.format('ddd MMM DD YYYY hh:mm a')
     def daydatetimesec(self):
         """ Return as fixed length e.g. 'ddd Oct 09 2013 04:10:32 pm' """
-        return self.arrow.format('ddd MMM DD YYYY hh:mm:ss a')
+        return self.format('ddd MMM DD YYYY hh:mm:ss a')
     def slashes(self):
         """ Return as e.g. '06/09/13' """
-        return self.arrow.format('MM/DD/YY')
+        return self.format('MM/DD/YY')
     def assigndate(self):
         """ Return as e.g. 'Thu Jan 26' or 'Tue Jan 23 2pm' """
-        datetime = self.arrow.format('ddd MMM D h:mm a')
+        datetime = self.format('ddd MMM D h:mm a')
         if Time.defaulttime in datetime:
-            return self.arrow.format('ddd MMM D')
+            return self.format('ddd MMM D')
         else:
             return datetime
     def assigndatedetail(self):
         """ Return as e.g. 'Tue Jan 23 2pm' """
         # Always include h:mm ; for detailed assignment date
-        return self.arrow.format('ddd MMM D h:mm a')
+        return self.format('ddd MMM D h:mm a')
     def assignISOdate(self):
         """ Return as e.g. '2017-09-03' or '2017-09-4 2pm' """
-        datetime = self.arrow.format('YYYY-MM-DD h:mm a')
+        datetime = self.format('YYYY-MM-DD h:mm a')
         if Time.defaulttime in datetime:
-            return self.arrow.format('YYYY-MM-DD')
+            return self.format('YYYY-MM-DD')
         else:
             return datetime
     def semester(self):
@@ -292,20 +359,40 @@ class Time:
         # YYYY-01-01           => Spring
         # YYYY-06-01 or 07-01  => Summer
         # YYYY-09-01           => Fall
-        month = self.arrow.month
+        month = self.when.month
         if month < 6:
             season = 'Spring '
         elif month < 9:
             season = 'Summer '
         else:
             season = 'Fall '
-        return season + str(self.arrow.year)
+        return season + str(self.when.year)
     def str(self):
         return str(self)
     def shift_minutes(self, mins):
         self.arrow = self.arrow.shift(minutes=mins)
         return self
 
+# The arrow format tokens (in english) that Time.format understands.
+_month_names = ('January', 'February', 'March', 'April', 'May', 'June', 'July',
+                'August', 'September', 'October', 'November', 'December')
+_day_names = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+_time_formats = {
+    'YYYY': lambda when: '{:04d}'.format(when.year),
+    'YY':   lambda when: '{:04d}'.format(when.year)[2:],
+    'MMMM': lambda when: _month_names[when.month - 1],
+    'MMM':  lambda when: _month_names[when.month - 1][:3],
+    'MM':   lambda when: '{:02d}'.format(when.month),
+    'DD':   lambda when: '{:02d}'.format(when.day),
+    'D':    lambda when: str(when.day),
+    'ddd':  lambda when: _day_names[when.weekday()],
+    'hh':   lambda when: '{:02d}'.format((when.hour - 1) % 12 + 1),
+    'h':    lambda when: str((when.hour - 1) % 12 + 1),
+    'mm':   lambda when: '{:02d}'.format(when.minute),
+    'ss':   lambda when: '{:02d}'.format(when.second),
+    'a':    lambda when: 'am' if when.hour < 12 else 'pm'}
+_time_tokens = re.compile('|'.join(sorted(_time_formats, key=len, reverse=True)))
+
 def clean_access_dict(dict):
     """ Return access dict with unicode replaced by str 
         >>> dirty = {u'one': u'alpha', 'two':[u'beta', 'gamma']}
@@ -437,6 +524,9 @@ def size_in_bytes(n):
     else:
         return '{:3}G'.format((n+500000000) // 1000000000)
 
+# The "(~~/" and "(~/" at the start of markdown links ; see link_translate.
+_course_links = re.compile(r'\((~~?)/')
+
 def link_translate(course, html):
     """ return html string with ~/ and ~~/ links translated
         into the appropriate course and site urls """
@@ -456,20 +546,17 @@ def link_translate(course, html):
     # For this to see the markdown syntax, it must be run
     # before markdown2html. 
     #
-    # 1 :
-    #html = html.replace(r'~~/', r'/' + url_base + r'/')    
-    html = html.replace('(~~/', '(/' + url_base + r'/')
-    # ... trying to do that only do that within markdown links.
-    #html = re.sub(r'(\[[^\]]*\]\([^)]*)\~\~\/([^)]*\))',
-    #              r'\1' + '/' + url_base + '/' + r'\2', html)
-    #
-    # 2 : 
-    #html = html.replace(r'~/', course_url_with_slash)
-    html = html.replace('(~/', '(' + course_url_with_slash)    
-    # again, trying to do that only within markdown links.
-    #html = re.sub(r'(\[[^\]]*\]\([^)]*)\~\/([^)]*\))',
-    #              r'\1' + course_url_with_slash + r'\2', html)
-    return html
+    # Both are done in one pass over the text :
+    #   (~~/  =>  (/courses/          i.e. the site
+    #   (~/   =>  (/courses/demo/     i.e. this course
+    site_url_with_slash = '(/' + url_base + '/'
+    course_url_with_slash = '(' + course_url_with_slash
+    def translate(match):
+        if match.group(1) == '~~':
+            return site_url_with_slash
+        else:
+            return course_url_with_slash
+    return _course_links.sub(translate, html)
 
 def whitestrip(x):
     """ strip whitespace """
@@ -497,42 +584,109 @@ def parse_access_string(access):
         names = names[0]
     return names
 
-def make_marker(bits=64):
-    """ Return a unique string that , for marking boundaries in text """
-    #  i.e. '|-b1dda1c7f14cd89e-|'
-    # In python2, hex() on big numbers gives i.e. '0x3333333333L'.
-    # I'll drop the 1st two and last chars with [2:-1].
-    return '|-'+hex(random.getrandbits(64))[2:-1]+'-|'
+# The mathjax spans $$...$$ ,  \(...\) , \[...\] , each within one line.
+_mathjax_spans = re.compile(r'\$\$.*?\$\$|\\\(.*?\\\)|\\\[.*?\\\]')
+
+# The markers that mathjax_replace puts in their place.
+_mathjax_markers = re.compile(r'\|-[0-9a-f]{16}-\d+-\|')
 
 def mathjax_replace(text):
     """ Replace substrings of text between several boundaries
         $$...$$ ,  \(...\) , \[...\] with unique-ish boundary markers.
         Return new text and dictionary of markers and replaced substrings.
+        The text is scanned once, left to right, as mathjax does.
+        >>> (text, replacements) = mathjax_replace('a $$x$$ b $$y$$ c')
+        >>> len(replacements), '$$' in text
+        (2, False)
+        >>> undo_mathjax_replace(text, replacements)
+        'a $$x$$ b $$y$$ c'
     """
     replacements = {}
-    for expr in (r'\$\$.*?\$\$',       #   $$ ... $$
-                 r'\\\(.*?\\\)',       #   \( ... \)
-                 r'\\\[.*?\\\]'):      #   \[ ... \]
-        pattern = re.compile(expr)
-        while True:
-            match = re.search(pattern, text)
-            if not match:
-                break
-            substring = match.group(0)
-            m = make_marker()
-            replacements[m] = substring
-            text = text.replace(substring, m)
+    prefix = '|-{:016x}-'.format(random.getrandbits(64))
+    def protect(match):
+        m = prefix + str(len(replacements)) + '-|'
+        replacements[m] = match.group(0)
+        return m
+    text = _mathjax_spans.sub(protect, text)
     return (text, replacements)
 
 def undo_mathjax_replace(text, replacements):
-    for mark in replacements:
-        text = text.replace(mark, replacements[mark])
-    return text
-
-def markdown2html(string, extras=True):
+    if not replacements:
+        return text
+    return _mathjax_markers.sub(
+        lambda match: replacements.get(match.group(0), match.group(0)), text)
+
+# markdown2 bug fix : within an href=... , 
+#   query string & should not be escaped to &amp;
+#   semi colons should not be inserted into link
+_href_values = re.compile(r'href=[^\s>]*')
+
+def fix_hrefs(html):
+    """ Return html with &amp; => & and ; removed in href values
+        >>> fix_hrefs('<a href="/x?a=1&amp;b=2;">x&amp;y;</a>')
+        '<a href="/x?a=1&b=2">x&amp;y;</a>'
+    """
+    def fix(match):
+        href = match.group(0)
+        while '&amp;' in href:      # e.g. &amp;amp; => &amp; => &
+            href = href.replace('&amp;', '&')
+        return href.replace(';', '')
+    return _href_values.sub(fix, html)
+
+# markdown2's extras that umber's pages use ; see umber/docs/markup.md
+markdown2_extras = ['code-friendly', 'fenced-code-blocks', 'footnotes',
+                    'pyshell', 'tables', 'cuddled-lists', 'markdown-in-html']
+
+def _markdown2(string, extras):
+    if extras:
+        output = markdown(string, extras=markdown2_extras)
+    else:
+        output = markdown(string)
+    return fix_hrefs(output)    # see fix_hrefs
+
+def _markdown_it(string, extras):
+    # markdown-it-py, CommonMark ; needs pip install markdown-it-py
+    # and (for footnotes) mdit-py-plugins
+    global _markdown_it_parsers
+    if not _markdown_it_parsers:
+        from markdown_it import MarkdownIt
+        plain = MarkdownIt('commonmark')
+        extended = MarkdownIt('commonmark').enable('table')
+        try:
+            from mdit_py_plugins.footnote import footnote_plugin
+            extended = extended.use(footnote_plugin)
+        except ImportError:
+            pass
+        _markdown_it_parsers = {False: plain, True: extended}
+    return _markdown_it_parsers[bool(extras)].render(string)
+_markdown_it_parsers = {}
+
+def _mistune(string, extras):
+    # mistune (version 2 or 3) ; needs pip install mistune
+    global _mistune_parsers
+    if not _mistune_parsers:
+        import mistune
+        _mistune_parsers = {
+            False: mistune.create_markdown(escape=False),
+            True: mistune.create_markdown(escape=False,
+                                          plugins=['table', 'footnotes'])}
+    return _mistune_parsers[bool(extras)](string)
+_mistune_parsers = {}
+
+# The markdown engines that markdown2html can use, {name: function} ;
+# settings.markdown_engine picks one. Each function takes the markdown
+# (with its math already protected) and extras (True or False), and
+# returns html. See misc/markdown_engines.py to compare them.
+markdown_engines = {'markdown2': _markdown2,
+                    'markdown-it': _markdown_it,
+                    'mistune': _mistune}
+
+def markdown2html(string, extras=True, engine=None):
     """ Convert markdown-formatted text to html 
         >> markdown2html(r'Formula \\( \\frac{1}{x} \\)')
         u'<p>Formula \\( \\frac{1}{x} \\)</p>\n'
+        >>> markdown2html('[a](b?c=1&d=2)', engine='markdown2')
+        '<p><a href="b?c=1&d=2">a</a></p>\\n'
     """
     try:       # make sure string is really a string and not bytes
         string = string.decode('utf8')
@@ -541,29 +695,12 @@ def markdown2html(string, extras=True):
     #print_debug(u" markdown2html: string before replace '{}'".format(string))    
     (string, replacements) = mathjax_replace(string)
     #print_debug(u" markdown2html: string after replace '{}'".format(string))
-    if extras:
-        output = markdown(string,
-                    extras=['code-friendly', 'fenced-code-blocks',
-                            'footnotes', 'pyshell', 'tables',
-                            'cuddled-lists', 'markdown-in-html'])
-    else:
-        output = markdown(string)
+    output = markdown_engines[engine or markdown_engine](string, extras)
     #print_debug(u" markdown2html: string after markdown '{}'".format(string))
     #print_debug(u" markown2html: replacemements '{}'".format(
     #  unicode(replacements)))
     output = undo_mathjax_replace(output, replacements)
     #print_debug(u" markdown2html: string after undo ''".format(string))  
-    #
-    # markdown2 bug fix :
-    #   query string & should not be escaped to &amp;
-    #   semi colons should not be inserted into link
-    href_amp = re.compile(r'href=([^\s>]*)&amp;')
-    href_semi = re.compile(r'href=([^\s>]*);')
-    while re.search(href_amp, output):
-        output = re.sub(href_amp, r'href=\1&', output)
-    while re.search(href_semi, output):
-        output = re.sub(href_semi, r'href=\1', output)
-    # ---
     return output
 
 def split_url(urlpath):
@@ -594,20 +731,59 @@ def pygment_webpage(filename, body):
 """.format(filename, pygments_css, body)
     return result
 
+# pygments lexer names for file extensions, including the code
+# extensions in settings.umber_mime_types ; see pygmentize.
+pygments_lexers = {
+    '.py': 'python', '.c': 'c', '.h': 'c', '.i': 'c', '.cc': 'cpp',
+    '.cpp': 'cpp', '.c++': 'cpp', '.hpp': 'cpp', '.c#': 'csharp',
+    '.cs': 'csharp', '.dot': 'graphviz', '.lisp': 'common-lisp',
+    '.clisp': 'common-lisp', '.java': 'java', '.hs': 'haskell',
+    '.pl': 'perl', '.tex': 'latex', '.rb': 'ruby', '.s': 'gas',
+    '.objdump': 'objdump', '.sql': 'sql', '.scm': 'scheme',
+    '.rkt': 'racket', '.rs': 'rust', '.swift': 'swift', '.scss': 'scss',
+    '.css': 'css', '.map': 'json', '.json': 'json', '.svelte': 'html',
+    '.html': 'html', '.jsx': 'jsx', '.js': 'javascript',
+    '.ts': 'typescript', '.ino': 'arduino', '.lua': 'lua', '.go': 'go',
+    '.sh': 'bash', '.yaml': 'yaml', '.md': 'markdown',
+    '.yvtm': 'text', '.vtm': 'text', '.csv': 'text', '.out': 'text',
+    '.txt': 'text'}
+
+_lexers = {}       # {name: pygments lexer}
+
+def lexer_name(filename):
+    """ Return the pygments lexer name for a filename, or None
+        >>> lexer_name('hello.py'), lexer_name('DATA.CSV'), lexer_name('x.zz')
+        ('python', 'text', None)
+    """
+    return pygments_lexers.get(os.path.splitext(filename)[1].lower())
+
+def _lexer(name):
+    if name not in _lexers:
+        _lexers[name] = get_lexer_by_name(name)
+    return _lexers[name]
+
 def pygmentize(code, filename=None, language=None):
     """ return html syntax higlighted code """
     # See  - http://pygments.org/docs/quickstart/ .
     #      - http://pygments.org/docs/quickstart/#guessing-lexers
-    from pygments import highlight
-    from pygments.formatters import HtmlFormatter
-    from pygments.lexers import get_lexer_by_name, guess_lexer, \
-                                guess_lexer_for_filename
-    if filename:
-        lexer = guess_lexer_for_filename(filename, code) # add stripall=True ?
-    elif language:
-        lexer = get_lexer_by_name(language)
-    else:
-        lexer = guess_lexer(code)
+    # Code bigger than pygments_max_bytes isn't highlighted.
+    if len(code) > pygments_max_bytes:
+        if isinstance(code, bytes):
+            code = code.decode('utf8', 'replace')
+        code_as_html = '<div class="codehilite"><pre>{}</pre></div>\n'.format(
+            html_escape(code, quote=False))
+        return pygment_webpage(filename, code_as_html)
+    try:
+        if filename and lexer_name(filename):
+            lexer = _lexer(lexer_name(filename))
+        elif filename:
+            lexer = guess_lexer_for_filename(filename, code) # add stripall=True ?
+        elif language:
+            lexer = _lexer(language)
+        else:
+            lexer = guess_lexer(code)
+    except ClassNotFound:
+        lexer = _lexer('text')
     formatter = HtmlFormatter(linenos=False, cssclass='codehilite', encoding='utf-8')
     code_as_html = highlight(code, lexer, formatter)
     return pygment_webpage(filename, code_as_html)